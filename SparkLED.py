@@ -21,8 +21,16 @@ from datetime import datetime
 import socket
 from time import sleep
 import requests
+import numpy as np
 from SparkLED_lib import *
+import SparkLED_assets
+from SparkLED_clock import DigitalClock
 import SparkLED_data
+import SparkLED_events
+import SparkLED_protocol
+import SparkLED_stats
+from SparkLED_text import Ticker
+from SparkLED_framebuffer import ScrollCanvas
 
 # Global variable definitions
 glob.NUM_LEDS = 256
@@ -62,33 +70,42 @@ def initialize():
 	print("- Connected to Spark Core server successfully")
 
 	SparkCore.settimeout(5)  # No reason why it should take anywhere near even a second once connection is established
+	SparkCore.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Otherwise Nagle holds back frames while earlier ones are unacknowledged
 
 	glob.connected = True
-	SparkCore.sendall(b'\x00' + b'K')  # This will initialize connection if first connect,
-	# Will otherwise be treated as normal keepalive by core,
-	# in case this program crashes and reconnects to a
-	# normally running PI
-
 	try:
-		while True:
-			if SparkCore.recv(1) == b'A': break  # We're stuck here until the SparkCore sends us the ack
+		# \x00K will initialize connection if first connect, will otherwise be treated as normal keepalive by core,
+		# in case this program crashes and reconnects to a normally running PI. We're stuck until the SparkCore sends
+		# us the ack. The \x00<version> pair after \x00K is ignored by servers that only speak protocol 1
+		glob.protocol_version = SparkLED_protocol.handshake(SparkCore, glob.PROTOCOL)
 	except socket.error as error:
 		print("ERROR: Connect failed:", format(error))
 		exit(1)
 
 	print("- Acknowledgement (b'A') received from SparkCore - ready!")
+
+	glob.frame_filter = SparkLED_protocol.FrameFilter(glob.SKIP_DUPLICATES, glob.SIMILAR_THRESHOLD)  # New connection, blank display
+	if glob.protocol_version >= SparkLED_protocol.PROTOCOL_PIPELINED:
+		glob.frame_link = SparkLED_protocol.PipelinedSender(SparkCore, glob.PIPELINE_WINDOW,
+		                                                    encoder=SparkLED_protocol.FrameEncoder(glob.DELTA_FRAMES, glob.COMPRESS_FRAMES),
+		                                                    stats=SparkLED_stats.stats)
+		print("- Using pipelined protocol", glob.protocol_version, "with", glob.PIPELINE_WINDOW, "frames in flight")
+	else:
+		glob.frame_link = None
+		print("- Using stop-and-wait protocol (G/A/D)")
 	print("--- INITIALIZATION COMPLETE ---\n")
 
 	return SparkCore
 
 
-def scroll_display_buffer(string_length, speed, display_buffer, aa=True):
+def scroll_display_buffer(string_length, speed, display_buffer, aa=True, steps=None, wrap=False):
 	"""
     Scrolls whatever is in display_buffer left until interrupted by a True glob.abort_flag
-    NOTE: Only works for single color with anti-aliasing
     @param string_length: number of number of full 16x16 blocks (normally characters)
     @param speed: scroll speed (1 - 10)
-    @param aa: anti-alias intermediate steps (True / False)
+    @param aa: anti-alias intermediate steps (True / False), works for any colors
+    @param steps: number of intermediate steps per pixel with anti-aliasing (None -> glob.SCROLL_STEPS)
+    @param wrap: loop seamlessly from the end of display_buffer back to its beginning (for buffers without blank padding)
     """
 
 	if speed < 1 or speed > 10:  # Sanity checking speed argument
@@ -96,213 +113,145 @@ def scroll_display_buffer(string_length, speed, display_buffer, aa=True):
 		exit(1)
 
 	speed = (11 - speed) * 2 / 100
+	if steps is None: steps = glob.SCROLL_STEPS  # Read now, so changing the setting at runtime takes effect
+	if not aa: steps = 1
+	canvas = ScrollCanvas(display_buffer[:, :string_length * 16], 16, wrap)  # Every frame is a window view into this
+	frames = np.zeros((steps, 16, 16, 3), dtype=np.uint8)  # The intermediate frames, computed once per pixel scrolled
+	clock = FrameClock()  # Absolute deadlines, so the time spent sending frames doesn't slow the scroll down
 
-	values_per_line = len(
-		display_buffer) / 16  # The number og LED value COLUMNS  we have to display, which must finally be copied to the glob.led_buffer
 	while not glob.abort_flag:  # Runs until glob.abort_flag gets set
 
-		cutoff = values_per_line - 16  # how much we need to skip from each line to make the data fit into screen buffer
+		for scroll_offset in range(canvas.positions):
+			# The visible window is the 16 columns of the canvas starting at scroll_offset, plus the one scrolling in
+			subpixel_frames(canvas.window(scroll_offset, 1), steps, frames)
 
-		for scroll_offset in range(string_length * 16 - 16):
-			for line in range(16):
-				visible_start = int(
-					line * (16 + cutoff)) + scroll_offset  # Start (in the display_buffer) of the visible line
-				visible_end = int(
-					line * (16 + cutoff) + 16) + scroll_offset  # End (in the display_buffer) of the visible line
-				visible_line = display_buffer[visible_start: visible_end]
+			for frame in frames:  # Frame 0 is the window itself, the rest are on their way one pixel to the left
+				glob.led_buffer.blit(frame)
+				present()
+				clock.wait(speed / steps)  # 0.01 gives a reasonable speed, as we need 10 of those per "real" left movement
+				if glob.abort_flag: break  # Stopping at once, e.g. for a priority event (see SparkLED_events.py)
+			if glob.abort_flag: break
 
-				# After each "virtual scroll left" we need to update the screen
-				# for rgb in range(16):          # We go through one full row at a time
-				glob.led_buffer[line * 16: line * 16 + 16] = visible_line[:16]
 
-			# Display has now been moved one step to the left, and we are ready to display
-			glob.transmit_flag = 1
+def scroll_ticker(ticker, speed, aa=True, steps=None):
+	"""
+    Scrolls a Ticker left until interrupted by a True glob.abort_flag. Text appended to the ticker (e.g. from a sensor
+    thread) joins the end of the message while it scrolls, and when the ticker runs dry the display scrolls out to black
+    and waits for more. Memory use is constant, however long the ticker runs
+    @param ticker: SparkLED_text.Ticker
+    @param speed: scroll speed (1 - 10)
+    @param aa: anti-alias intermediate steps (True / False)
+    @param steps: number of intermediate steps per pixel with anti-aliasing (None -> glob.SCROLL_STEPS)
+    """
+
+	if speed < 1 or speed > 10:  # Sanity checking speed argument
+		print("= Error: scroll speed must be an integer from 1 to 10")
+		exit(1)
 
-			if aa:
-				glob.led_buffer_original = glob.led_buffer[:]  # We need to pass the unchanged buffer as well
-				for anti_alias_step in range(
-						10):  # We now anti-alias scroll everything one pixel to the left to make it smooth, in 10 steps
-					glob.led_buffer = anti_alias_left_10(glob.led_buffer, glob.led_buffer_original, anti_alias_step)
+	speed = (11 - speed) * 2 / 100
+	if steps is None: steps = glob.SCROLL_STEPS  # Read now, so changing the setting at runtime takes effect
+	if not aa: steps = 1
+	window = np.zeros((16, 17, 3), dtype=np.uint8)  # The 16 visible columns plus the one scrolling in
+	frames = np.zeros((steps, 16, 16, 3), dtype=np.uint8)
+	clock = FrameClock()
 
-					glob.transmit_flag = True  # We send the intermediate step to the screen
+	while not glob.abort_flag:  # Runs until glob.abort_flag gets set
+		ticker.window(window)  # The 17 leftmost columns still in the ticker
+		subpixel_frames(window, steps, frames)
 
-					sleep(
-						speed / 10)  # 0.01 gives a reasonable speed, as weed need 10 of those per "real" left movement
+		for frame in frames:
+			glob.led_buffer.blit(frame)
+			present()
+			clock.wait(speed / steps)
+			if glob.abort_flag: return
 
-			# The glob.led_buffer is now scrolled one step to the left - we then repeat the loop. This replaces the anti-alias scrolled buffer with the "real" one,
-			# which is identical except it also adds a new column to the right from the display_buffer (where we keep our text / graphics)
-			if not aa: sleep(speed)
+		ticker.advance()  # Drops the column that scrolled off, making room for more text in the ring
 
 
 def show_img(image, brightness=-1):
 	"""
     Displays an image (16x16) on the LED display. Will blend with black if alpha. Supports animated images
+    The decoded frames are cached (see SparkLED_assets.py), so showing the same image again does no decoding
     TODO: Support animated GIFs with offsets
-    @param image: File name (relative or abs path)
+    @param image: File name (relative or abs path), or a .sled file from Tools/compile_assets.py (memory mapped, never decoded)
     """
-	animated = False
-	run = True  # We set this flag to False after first run if there is no animation
 
 	# What we have learned so far:
 	# PNG: No problem! 256 tuples of rgb translates easy into led_buffer
-	# GIF: First we seek() the first image (even if there is only one), wich gives us a grayscale version of the image,
-	# then we have to perform some magic to get the color in. This because GIFs store their color palette data in a
-	# palette table, with each pixel value a reference to this table. So to get to led_buffer we need to convert this
+	# GIF: GIFs store their color palette data in a palette table, with each pixel value a reference to this table.
+	# SparkLED_assets converts every frame to RGB once, merging any alpha channel with black, and keeps the result
 
 	try:
-		img = Image.open(image)
+		animation = SparkLED_assets.cache.get(image)
 	except FileNotFoundError:
 		print("Unable to load image ", image, "- file not found")
 		sys.exit(1)
-
-	if not (img.size[0] == img.size[1] == 16):
+	except ValueError:
 		sys.exit("ERROR: Only accept 16x16 images")
 
 	if brightness != - 1: ext_effect(glob.sparkCore, 'brightness',
 	                                 brightness)  # The default is to not mess with brightness
 
-	if 'duration' in img.info:
-		animated = True
-
-	if img.mode in ('RGBA', 'LA'):  # Image has alpha channel - which we merge with black
-		img = pure_pil_alpha_to_color_v2(img, color=(0, 0, 0))  # Note, this destroys the img.info data
-
-	while run:
-		if not animated: run = False  # No animation -> only one run
-
+	clock = FrameClock()  # Frame durations are kept exactly, however long sending a frame takes
+	for frame, duration in animation:
 		# TODO: img = img.filter(ImageFilter.GaussianBlur(radius=1))
+		glob.led_buffer.copy_from(frame)
+		present()
 
-		# We convert the list of RGB tuples into a list of RGB lists
-		if img.format == "GIF":
-			converted_img = img.convert()  # This adds palette data to GIFs (otherwise monochrome), BUT DESTROYS SEEK FUNCTIONALITY
-			rgb_pixels = list(converted_img.getdata())
-		else:
-			rgb_pixels = list(img.getdata())
-
-		# TODO: THIS IS WHERE IT FAILS!!!! rgb_pixels is not a list of lists and must be converted!!!
-		# I don't get why, but instead of getting what we want, we get a list of tuples with R,G,B,A, so we make a list of lists and strip the A
-		for n in range(16 * 16):
-			if len(rgb_pixels[n]) == 4:
-				rgb_pixels[n] = list(rgb_pixels[n][:-1])
-			else:
-				rgb_pixels[n] = list(rgb_pixels[n])
-
-		glob.led_buffer = rgb_pixels
-		glob.transmit_flag = True
-
-		if animated:
-			sleep(img.info['duration'] / 1000)  # Waiting for time stipulated in GIF
-
-			try:
-				img.seek(img.tell() + 1)  # Seeking to next frame in animated gif
-			except EOFError:  # We've read the last frame
-				run = False
+		if animation.animated: clock.wait(duration)  # Waiting for time stipulated in GIF
+		if glob.abort_flag: break  # Preempted, e.g. by a priority event (see SparkLED_events.py)
 
 
 def clock_digital(color):
 	"""
-    Displays real-time clock on display using tiny 3x5 font
+    Displays real-time clock on display using tiny 3x5 font. Only the digits that change are redrawn, and a frame is
+    only sent when they do (once a minute). For a clock on top of other effects, see SparkLED_clock.DigitalClock.overlay()
     @param color: font color
     @return:
     """
+	clock = DigitalClock(color)  # Digit sprites are built once, here
 
-	font_tiny = list(SparkLED_data.numfont3x5)
-	black = [0, 0, 0]
-
-	n = [None] * 10
-	for j in range(10):
-		n[j] = [[0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0],
-		        [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0],
-		        [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0]]
-
-	for number in range(10):
-		for byte_value in range(5):
-			if font_tiny[byte_value + number * 5] & 0b0100:
-				n[number][0 + byte_value * 3] = color
-			else:
-				n[number][0 + byte_value * 3] = black
-
-			if font_tiny[byte_value + number * 5] & 0b0010:
-				n[number][1 + byte_value * 3] = color
-			else:
-				n[number][1 + byte_value * 3] = black
+	glob.led_buffer.clear()  # Everything that isn't a digit is black
+	clock.draw(glob.led_buffer, force=True)
+	present()  # Only finished frames are published, so there is no flicker
 
-			if font_tiny[byte_value + number * 5] & 0b0001:
-				n[number][2 + byte_value * 3] = color
-			else:
-				n[number][2 + byte_value * 3] = black
-
-
-	# TODO: We got all the numbers in place now. Next is placing them on the display.
-
-	# For debugging
 	while not glob.abort_flag:
-		# Got all the numbers in their respective lists - must find time
-
-		date_time = datetime.today()
-		date_time = date_time.timetuple()
-
-		month = list(map(int, str(date_time[1])))
-		day = list(map(int, str(date_time[2])))
-		hour = list(map(int, str(date_time[3])))
-		minute = list(map(int, str(date_time[4])))
-
-		if len(month) == 1: month = [0] + month
-		if len(day) == 1: day = [0] + day
-		if len(hour) == 1: hour = [0] + hour
-		if len(minute) == 1: minute = [0] + minute
-
-		# Screen layout:
-		# 16 x 16: we need 3 leds per number, with 1 led in between each, four numbers across: xxx0 xxx0 0xxx 0xxx - in the double zeron in the middle we have : or / for presentation
-		# Vertically we have 5 lines per number: 3 rows with only one space. Probably better to only do two rows (hh:mm and dd:MM), perhaps with a line between: 0NNN NN0L 0NNN NN00
-		# TODO: Anti-aliasing to be considered lates
-		glob.transmit_flag = 0  # To avoid flicker
-
-		# First 5 rows of numbers (hh:mm)
-		glob.led_buffer[0:16] = [black] * 16  # First we add one blank line
-		offset = 1
-
-		for line in range(offset, 6):
-			glob.led_buffer[line * 16 + 0:line * 16 + 3] = n[hour[0]][(line - offset) * 3:(line - offset) * 3 + 3]
-			glob.led_buffer[line * 16 + 3] = black
-			glob.led_buffer[line * 16 + 4:line * 16 + 7] = n[hour[1]][(line - offset) * 3:(line - offset) * 3 + 3]
-			glob.led_buffer[line * 16 + 7] = black
-
-			glob.led_buffer[line * 16 + 8] = black
-			glob.led_buffer[line * 16 + 9:line * 16 + 12] = n[minute[0]][(line - offset) * 3:(line - offset) * 3 + 3]
-			glob.led_buffer[line * 16 + 12] = black
-			glob.led_buffer[line * 16 + 13:line * 16 + 16] = n[minute[1]][(line - offset) * 3:(line - offset) * 3 + 3]
-
-		glob.led_buffer[6 * 16:9 * 16] = [black] * 16 * 3  # Three blank lines
-
-		offset = 9
+		if wait_or_abort(min(1, clock.seconds_to_change())): break  # Waking up at least once a second, and at once on abort()
 
-		for line in range(offset, 14):
-			glob.led_buffer[line * 16 + 0:line * 16 + 3] = n[day[0]][(line - offset) * 3:(line - offset) * 3 + 3]
-			glob.led_buffer[line * 16 + 3] = black
-			glob.led_buffer[line * 16 + 4:line * 16 + 7] = n[day[1]][(line - offset) * 3:(line - offset) * 3 + 3]
-			glob.led_buffer[line * 16 + 7] = black
+		if clock.draw(glob.led_buffer): present()  # glob.led_buffer still holds the last frame, so we only update changed digits
+	return
 
-			glob.led_buffer[line * 16 + 8] = black
-			glob.led_buffer[line * 16 + 9:line * 16 + 12] = n[month[0]][(line - offset) * 3:(line - offset) * 3 + 3]
-			glob.led_buffer[line * 16 + 12] = black
-			glob.led_buffer[line * 16 + 13:line * 16 + 16] = n[month[1]][(line - offset) * 3:(line - offset) * 3 + 3]
 
-		glob.led_buffer[16 * 14:16 * 16] = [black] * 16 * 2
+def fade(brightness, seconds=1, steps=30):
+	"""
+    Fades the whole display (whatever is on it) to a brightness, e.g. fade(0) to fade out. Each step is one table
+    lookup in the serializer, no matter what is drawn, and the brightness stays until the next fade()
+    @param brightness: target brightness 0.0 (off) .. 1.0 (as drawn)
+    @param seconds: duration of the fade
+    @param steps: number of frames in the fade
+    """
+	clock = FrameClock()
+	start = glob.serializer.brightness
+	for step in range(1, steps + 1):
+		glob.serializer.set_brightness(start + (brightness - start) * step / steps)
+		present()  # Re-sending the frame in the buffer, at the new brightness
+		clock.wait(seconds / steps)
 
-		glob.transmit_flag = 1  # To avoid flicker
 
-		# print(len(glob.led_buffer)/16)
-		#print(glob.led_buffer)
-		sleep(1)
-	return
+def doorbell(event):
+	"""
+    Handler for doorbell events (see SparkLED_events.py): shows a bell for 5 seconds, unless another event comes first
+    @param event: SparkLED_events.Event
+    """
+	show_img('images/bell.png')
+	wait_or_abort(5)
 
 
 if __name__ == "__main__":  # Making sure we don't have problems if importing from this file as a module
 
 	buffer_to_screen.updates = 0  # We need to set this variable AFTER the function definition
 	glob.abort_flag = 0  # True if we want to abort current execution
-	glob.transmit_flag = False  # No screen updates until requested by a function
+	glob.governor = FrameGovernor(glob.TARGET_FPS, glob.MAX_LATENCY, glob.FRAME_POLICY)  # No screen updates until a function calls present()
 
 	glob.sparkCore = initialize()
 
@@ -310,7 +259,14 @@ if __name__ == "__main__":  # Making sure we don't have problems if importing fr
 
 	init_thread(transmit_loop,
 	            glob.sparkCore)  # Starts main transmit thread - to LED if not glob.OFFLINE, curses otherwise
-	# Does nothing until a function sets glob.transmit_flag = True
+	# Sleeps until a function calls present()
+
+	if glob.STATS_PORT: SparkLED_stats.serve(glob.STATS_PORT)  # Frame statistics as JSON on http://127.0.0.1:STATS_PORT/stats
+	if glob.STATS_INTERVAL: SparkLED_stats.log_periodically(glob.STATS_INTERVAL)
+
+	events = SparkLED_events.EventDispatcher()  # Priority events preempt whatever is on the display
+	events.on('doorbell', doorbell)
+	if glob.LOG_SERVER: SparkLED_events.EventListener(events, glob.LOG_SERVER, glob.LOG_SERVER_PORT).start()
 
 	#ext_effect(glob.sparkCore, 'brightness', 10)
 
@@ -321,7 +277,13 @@ if __name__ == "__main__":  # Making sure we don't have problems if importing fr
 
 	sleep(1)
 	while True:
-		if not glob.connected: glob.sparkCore = initialize()  # If we loose the connection we try reconnecting
+		if not glob.connected:  # If we loose the connection we try reconnecting
+			SparkLED_stats.stats.count('reconnects')
+			glob.sparkCore = initialize()
+			init_thread(transmit_loop, glob.sparkCore)  # The transmit thread of the lost connection has ended
+			if not events.pending(): clear_abort()  # connection_lost() aborted the effect that was running
+
+		events.run_pending()  # Events that aborted the last effect are shown before anything else
 
 		#clock_digital([255,128,0])
 
@@ -332,6 +294,13 @@ if __name__ == "__main__":  # Making sure we don't have problems if importing fr
         while True: pass        # NOTE: If you do not stop it here, there will be 1000000 scrollers on top of each other!!!
 		"""
 
+		"""
+        ticker = Ticker()  # Endless ticker: append() from anywhere, and the text joins the end while it scrolls
+        ticker.append("Scrolling is fun!?! ", [100, 10, 5])
+        init_thread(scroll_ticker, ticker, 10, True)
+        while True: ticker.append(" " + datetime.now().strftime("%H:%M:%S"), [0, 100, 0]); sleep(10)
+		"""
+
 
 		#while True: print("I am free")
 		#clock_digital([128,0,0])
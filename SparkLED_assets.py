@@ -0,0 +1,197 @@
+""" Image and animation assets for SparkLED.
+        Images are decoded once: every frame of a GIF (or the single frame of a PNG) is converted to RGB, with the
+        alpha channel merged with black, and stored as one (frames, height, width, 3) uint8 array next to a table of
+        frame durations. The AssetCache keeps the decoded animations keyed by path and modification time, so replaying
+        an animation is a copy per frame and no PIL work at all, while an edited file is decoded again.
+        Least recently used animations are evicted when the cache grows beyond its memory budget.
+
+        Animations can also be compiled ahead of time (Tools/compile_assets.py) into a packed file: a header, a table
+        of frame durations and the RGB frames, row order. load_compiled() maps such a file into memory, so playing it
+        needs no decoding at all, and the operating system only reads the pages that are actually shown.
+"""
+from collections import OrderedDict
+import mmap
+import os
+import struct
+import threading
+import numpy as np
+from PIL import Image
+import SparkLED_globals as glob
+
+
+class Animation:
+    """
+    The decoded frames of an image: frames[n] is shown for durations[n] seconds. Still images have one frame
+    """
+
+    def __init__(self, frames, durations, animated, mapped=None):
+        """
+        @param frames: (frames, height, width, 3) uint8 array
+        @param durations: seconds to show each frame
+        @param animated: True if the image has more than one frame (or a duration, as GIFs of one frame can have)
+        @param mapped: the memory map frames is a view of (see load_compiled()), None for decoded frames
+        """
+        self.frames = frames
+        self.durations = np.asarray(durations, dtype=np.float64)
+        self.animated = animated
+        self.mapped = mapped
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the animation. For a mapped file that is the whole mapping: the operating system may page it
+        out, but the map (and its file descriptor) stays until the animation is dropped, so the cache must count it
+        """
+        return (len(self.mapped) if self.mapped is not None else self.frames.nbytes) + self.durations.nbytes
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return zip(self.frames, self.durations)
+
+
+COMPILED_EXTENSION = '.sled'
+COMPILED_MAGIC = b'SLED'
+COMPILED_VERSION = 1
+COMPILED_HEADER = struct.Struct('<4sBHHBI')     # Magic, version, width, height, animated, frame count
+COMPILED_DURATION = np.dtype('<u4')             # Frame durations in milliseconds, one per frame after the header
+
+
+def decode_image(path, width=glob.WIDTH, height=glob.HEIGHT, resize=False):
+    """
+    Decodes every frame of an image file, merging the alpha channel with black
+    @param path: File name (relative or abs path)
+    @param width: required image width
+    @param height: required image height
+    @param resize: scale images of another size in stead of rejecting them
+    @return: Animation
+    """
+    img = Image.open(path)
+    if img.size != (width, height) and not resize:
+        raise ValueError("{} is {}x{}, not {}x{}".format(path, img.size[0], img.size[1], width, height))
+
+    animated = 'duration' in img.info
+    frames = []
+    durations = []
+    while True:
+        # GIFs store their colors in a palette table, so we convert every frame to RGBA and then merge with black
+        rgba = img.convert('RGBA')
+        if rgba.size != (width, height): rgba = rgba.resize((width, height), Image.LANCZOS)
+        rgba = np.asarray(rgba, dtype=np.uint16)
+        frames.append((rgba[..., :3] * rgba[..., 3:] + 127) // 255)      # Alpha blended with black, like pure_pil_alpha_to_color_v2()
+        durations.append(img.info.get('duration', 0) / 1000)
+        try:
+            img.seek(img.tell() + 1)     # Seeking to next frame in animated gif
+        except EOFError:                 # We've read the last frame
+            break
+
+    return Animation(np.array(frames, dtype=np.uint8), durations, animated)
+
+
+def write_compiled(animation, path):
+    """
+    Writes an Animation in the packed format read by load_compiled()
+    @param animation: Animation
+    @param path: output file name (normally ending in COMPILED_EXTENSION)
+    """
+    count, height, width = animation.frames.shape[:3]
+    durations = np.round(animation.durations * 1000).astype(COMPILED_DURATION)
+    with open(path, 'wb') as out:
+        out.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, width, height, animation.animated, count))
+        out.write(durations.tobytes())
+        out.write(np.ascontiguousarray(animation.frames, dtype=np.uint8).tobytes())
+
+
+def load_compiled(path):
+    """
+    Maps a compiled animation into memory - the frames are views of the file, nothing is decoded or copied
+    @param path: File name (relative or abs path) of a file written by write_compiled()
+    @return: Animation
+    """
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)     # Stays valid after the file is closed
+
+    if len(data) < COMPILED_HEADER.size:
+        raise ValueError("{} is not a compiled animation".format(path))
+    magic, version, width, height, animated, count = COMPILED_HEADER.unpack_from(data)
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+        raise ValueError("{} is not a compiled animation (version {})".format(path, COMPILED_VERSION))
+
+    offset = COMPILED_HEADER.size
+    durations = np.frombuffer(data, dtype=COMPILED_DURATION, count=count, offset=offset) / 1000
+    offset += count * COMPILED_DURATION.itemsize
+    frames = np.frombuffer(data, dtype=np.uint8, count=count * height * width * 3, offset=offset)
+    return Animation(frames.reshape(count, height, width, 3), durations, bool(animated), mapped=data)
+
+
+def load_asset(path, width=glob.WIDTH, height=glob.HEIGHT):
+    """
+    @param path: an image file, or an animation compiled by Tools/compile_assets.py
+    @return: Animation
+    """
+    if not path.endswith(COMPILED_EXTENSION): return decode_image(path, width, height)
+
+    animation = load_compiled(path)
+    if animation.frames.shape[1:3] != (height, width):
+        raise ValueError("{} is compiled for {}x{}, not {}x{}".format(path, animation.frames.shape[2],
+                                                                      animation.frames.shape[1], width, height))
+    return animation
+
+
+class AssetCache:
+    """
+    Decoded animations by path, least recently used first out when the memory budget is exceeded. Thread safe
+    """
+
+    def __init__(self, budget=glob.ASSET_CACHE_SIZE):
+        """
+        @param budget: maximum bytes of decoded frames to keep (an animation bigger than this is decoded every time)
+        """
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()    # (path, mtime, width, height) -> Animation, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, width=glob.WIDTH, height=glob.HEIGHT):
+        """
+        @param path: File name (relative or abs path)
+        @param width: width to decode the frames at
+        @param height: height to decode the frames at
+        @return: Animation, from the cache if the file hasn't changed since it was decoded at this size
+        """
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns, width, height)
+
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        animation = load_asset(path, width, height)     # Decoding outside the lock, so other threads aren't held up
+
+        with self.lock:
+            for stale in [k for k in self.entries if k[0] == path and k[1] != key[1]]: self._remove(stale)     # Older versions of the file
+            if animation.nbytes <= self.budget:
+                self.entries[key] = animation
+                self.size += animation.nbytes
+                while self.size > self.budget:
+                    self._remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return animation
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key).nbytes
+
+
+cache = AssetCache()        # Shared by show_img() and the async image effect
@@ -0,0 +1,356 @@
+""" asyncio core for SparkLED: one event loop drives rendering, sensor input and transmission concurrently,
+        in stead of a blocking socket, daemon threads and sleep() calls inside every effect.
+
+        CoreTransport  - async transport for the Spark Core protocol (both stop-and-wait and pipelined)
+        AsyncDisplay   - keeps the newest frame and a sender task that transmits it, capped at a frame rate
+        effects        - async generators yielding (frame, seconds to show it), played by AsyncDisplay.play() on a
+                         drift-free timer. Cancelling the task that plays an effect stops it at once
+        BlockingDisplay - thin blocking wrapper, running the event loop in a background thread
+
+        SparkLED.py itself still runs on threads and FrameGovernor: this core sits next to it, for programs that
+        want one event loop (SparkLED_canvas.py drives several Cores with it), and doesn't replace it. What makes
+        up the protocol - handshake, frame layout, FrameEncoder, the AckWindow of protocol 2, effect commands - is
+        shared with the blocking client in SparkLED_protocol.py, so only the I/O differs. Frames go through the same
+        FrameSerializer and FrameFilter, images come from the same SparkLED_assets cache and text from SparkLED_text.
+"""
+import asyncio
+import socket
+import threading
+import numpy as np
+import SparkLED_assets
+import SparkLED_globals as glob
+import SparkLED_protocol as protocol
+from SparkLED_framebuffer import Framebuffer, FrameSerializer
+from SparkLED_lib import text_to_buffer
+from SparkLED_stats import stats
+
+
+def _connect(host, port, version, timeout):
+    """
+    Connects with a blocking socket and runs SparkLED_protocol.handshake(), like SparkLED.initialize() does
+    @return: (socket, protocol version)
+    """
+    server = socket.create_connection((host, port), timeout)
+    server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)    # Acks and small delta frames must go out at once
+    try:
+        return server, protocol.handshake(server, version)
+    except OSError:
+        server.close()
+        raise
+
+
+class CoreTransport:
+    """
+    Async connection to a Spark Core (or the emulator). Only the I/O lives here, the protocol is SparkLED_protocol's
+    """
+
+    def __init__(self, reader, writer, version, window=glob.PIPELINE_WINDOW, encoder=None, stats=None):
+        """
+        @param reader: asyncio.StreamReader of the connection
+        @param writer: asyncio.StreamWriter of the connection
+        @param version: the protocol version negotiated
+        @param window: maximum number of frames in flight with protocol 2
+        @param encoder: FrameEncoder for protocol 2 frames (None -> a new one using glob.DELTA_FRAMES and glob.COMPRESS_FRAMES)
+        @param stats: optional SparkLED_stats.Stats, which gets the ack latency
+        """
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        self.encoder = encoder if encoder else protocol.FrameEncoder(glob.DELTA_FRAMES, glob.COMPRESS_FRAMES)
+        self.window = protocol.AckWindow(window, stats)
+
+        self.acks = asyncio.Condition()         # Notified every time an ack arrives
+        self.lock = asyncio.Lock()              # One frame or command on the wire at a time
+        self.error = None                       # Why the connection broke, raised by the next send_frame()
+        self._buffer = bytearray(protocol.FRAME_HEADER.size + 768)
+        self._ack_task = None
+
+    @classmethod
+    async def connect(cls, host, port=glob.PORT, version=glob.PROTOCOL, window=glob.PIPELINE_WINDOW, timeout=10):
+        """
+        Connects and performs the \x00K handshake, negotiating the protocol version. The handshake is the blocking
+        SparkLED_protocol.handshake(), run in a worker thread, before the socket is handed to asyncio
+        @return: CoreTransport
+        """
+        loop = asyncio.get_running_loop()
+        server, agreed = await loop.run_in_executor(None, _connect, host, port, version, timeout)
+        server.settimeout(None)
+        reader, writer = await asyncio.open_connection(sock=server)
+
+        transport = cls(reader, writer, agreed, window, stats=stats)
+        if agreed >= protocol.PROTOCOL_PIPELINED:
+            transport._ack_task = asyncio.ensure_future(transport._read_acks())
+        return transport
+
+    def in_flight(self):
+        return self.window.in_flight()
+
+    async def send_frame(self, frame, timeout=5, hold=False):
+        """
+        Sends one serialized frame
+        @param frame: serialized frame (bytes-like, e.g. from FrameSerializer.serialize())
+        @param timeout: seconds to wait for the Spark Core before giving up
+        @param hold: protocol 2 only - load the frame, but don't show it before show() is called
+        """
+        async with self.lock:
+            if self.version >= protocol.PROTOCOL_PIPELINED:
+                await self._wait_acks(lambda: not self.window.full(), timeout)
+
+                kind, payload = self.encoder.encode(frame)
+                if hold: kind |= protocol.KIND_HOLD
+                if protocol.FRAME_HEADER.size + len(payload) > len(self._buffer):
+                    self._buffer = bytearray(protocol.FRAME_HEADER.size + len(payload))
+                message = protocol.pack_frame(self._buffer, kind, self.window.next(), payload)
+                self.writer.write(bytes(message))   # The stream may keep what we write, and the buffer is reused
+                await self.writer.drain()
+                return
+
+            self.writer.write(b'\x00G')
+            await asyncio.wait_for(self._wait_for(b'A'), timeout)
+            self.writer.write(bytes(frame))     # The stream may keep what we write, and frame is reused by the serializer
+            await asyncio.wait_for(self._wait_for(b'D'), timeout)
+
+    async def wait_acked(self, timeout=5):
+        """
+        Waits until the Spark Core has acknowledged every frame sent (protocol 2)
+        """
+        await self._wait_acks(lambda: not self.window.in_flight(), timeout)
+
+    async def show(self):
+        """
+        Shows the frame sent with hold=True (protocol 2)
+        """
+        self.writer.write(b'\x00' + protocol.SHOW_CODE)
+        await self.writer.drain()
+
+    async def command(self, effect, value=None):
+        """
+        Triggers an external effect on the Spark Core, like ext_effect()
+        @param effect: 'brightness', 'hw_test' or 'blank'
+        @param value: effect value (brightness 0-255)
+        """
+        async with self.lock:
+            self.writer.write(protocol.effect_command(effect, value))
+            await self.writer.drain()
+
+    async def close(self):
+        if self._ack_task: self._ack_task.cancel()
+        try:
+            self.writer.write(b'\x00Q')     # Telling Spark Core to hang up connection
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+    async def _wait_acks(self, ready, timeout):
+        """
+        Waits until ready() is true, raising the error that ended the ack reader if the connection broke meanwhile
+        """
+        async with self.acks:
+            await asyncio.wait_for(self.acks.wait_for(lambda: self.error or ready()), timeout)
+        if self.error: raise self.error
+
+    async def _wait_for(self, code):
+        while await self.reader.readexactly(1) != code: pass       # Skipping the D of earlier effect commands
+
+    async def _read_acks(self):
+        try:
+            while True:
+                data = await self.reader.read(256)
+                if not data: raise ConnectionResetError("Spark Core closed the connection")
+                if self.window.feed(data):
+                    async with self.acks:
+                        self.acks.notify_all()
+        except ConnectionError as error:
+            self.error = error
+            async with self.acks:
+                self.acks.notify_all()
+
+
+class AsyncDisplay:
+    """
+    Schedules frames onto a CoreTransport. present() only stores the newest frame, and the sender task transmits it
+    when the link is free, no faster than fps. Frames presented faster than that replace each other (newest wins).
+    """
+
+    def __init__(self, transport, width=glob.WIDTH, height=glob.HEIGHT, fps=glob.TARGET_FPS):
+        self.transport = transport
+        self.fps = fps
+        self.serializer = FrameSerializer(width, height, gamma=glob.GAMMA)
+        self.frame = Framebuffer(width, height)
+        self.fresh = asyncio.Event()
+        self.filter = protocol.FrameFilter(glob.SKIP_DUPLICATES, glob.SIMILAR_THRESHOLD)   # Skips frames that change nothing
+        self.sent = 0
+        self.dropped = 0
+        self.error = None           # Why the sender task stopped, raised by present() from then on
+        self._sender = None
+
+    def present(self, pixels):
+        """
+        Publishes a frame. Copied into a preallocated buffer, so the caller may reuse pixels right away
+        @param pixels: Framebuffer or (height, width, 3) array
+        """
+        if self.error: raise self.error      # Nobody is sending any more
+        if self.fresh.is_set(): self.dropped += 1
+        self.frame.copy_from(pixels)
+        self.fresh.set()
+
+    def start(self):
+        if not self._sender:
+            self._sender = asyncio.ensure_future(self._send_loop())
+            self._sender.add_done_callback(self._sender_done)
+
+    async def play(self, effect):
+        """
+        Plays an effect: an async iterable of (frame, seconds to show it). The timer runs on absolute deadlines, so
+        time spent rendering and transmitting doesn't make the effect run slow
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        async for pixels, hold in effect:
+            self.present(pixels)
+            deadline += hold
+            if deadline < loop.time() - hold: deadline = loop.time()     # If we fall far behind, we resync in stead of rushing
+            await asyncio.sleep(deadline - loop.time())
+
+    async def close(self):
+        if self._sender: self._sender.cancel()
+        await self.transport.close()
+
+    def _sender_done(self, task):
+        """
+        The sender task only ends when cancelled, or when transmitting fails: then the display stops, and the error is
+        raised by the next present() (and so by play())
+        """
+        if task.cancelled(): return
+        self.error = task.exception()
+        print("ERROR: Sending to the Spark Core failed:", format(self.error))
+
+    def _serialize(self):
+        """
+        @return: the frame as it goes on the wire, after brightness and gamma - what the filter compares
+        """
+        return self.serializer.serialize(self.frame)
+
+    async def _transmit(self, data):
+        await self.transport.send_frame(data)
+
+    async def _send_loop(self):
+        loop = asyncio.get_running_loop()
+        next_send = loop.time()
+        dropped = self.dropped
+        while True:
+            await self.fresh.wait()
+            delay = next_send - loop.time()
+            if delay > 0: await asyncio.sleep(delay)
+
+            self.fresh.clear()
+            saturated = self.dropped > dropped      # Frames were replaced before we got to send them
+            dropped = self.dropped
+            data = self._serialize()
+            if not self.filter.check(data, saturated): continue
+
+            start = loop.time()
+            await self._transmit(data)
+            stats.record('send', loop.time() - start)
+            stats.frame_sent()
+            self.sent += 1
+            next_send = max(next_send + 1 / self.fps, loop.time())
+
+
+async def image_frames(image, repeat=1, hold=1):
+    """
+    Effect: shows an image (16x16), with every frame of animated GIFs shown for the time stipulated in the GIF
+    @param image: File name (relative or abs path), decoded once and then played from SparkLED_assets.cache
+    @param repeat: number of times to play animations
+    @param hold: seconds to show images that aren't animated
+    """
+    animation = SparkLED_assets.cache.get(image)
+    if not animation.animated: repeat = 1
+
+    for _ in range(repeat):
+        for frame, duration in animation:
+            yield frame, duration if animation.animated else hold
+
+
+async def scroll_frames(text, color, speed=5, width=glob.WIDTH):
+    """
+    Effect: scrolls a text message once, right to left
+    @param text: the message
+    @param color: list [r, g, b]
+    @param speed: scroll speed (1 - 10), as for scroll_display_buffer()
+    """
+    letters, display_buffer = text_to_buffer(text, *color)
+    for scroll_offset in range(display_buffer.shape[1] - width + 1):
+        yield display_buffer[:, scroll_offset:scroll_offset + width], (11 - speed) * 2 / 100
+
+
+async def ticker_frames(ticker, speed=5, width=glob.WIDTH):
+    """
+    Effect: scrolls a SparkLED_text.Ticker until cancelled, picking up text appended to it while scrolling
+    @param ticker: SparkLED_text.Ticker
+    @param speed: scroll speed (1 - 10), as for scroll_display_buffer()
+    """
+    window = np.zeros((ticker.atlas.height, width, 3), dtype=np.uint8)
+    while True:
+        ticker.window(window)
+        yield window, (11 - speed) * 2 / 100     # present() copies the window, so we can reuse it
+        ticker.advance()
+
+
+class BlockingDisplay:
+    """
+    Blocking wrapper around AsyncDisplay: the event loop runs in a daemon thread, and every method blocks until done
+    """
+
+    def __init__(self, host, port=glob.PORT):
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+        thread.start()
+        self.display = self._call(self._open(host, port))
+
+    async def _open(self, host, port):
+        display = AsyncDisplay(await CoreTransport.connect(host, port))
+        display.start()
+        return display
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def present(self, pixels):
+        if self.display.error: raise self.display.error
+        self.loop.call_soon_threadsafe(self.display.present, np.array(pixels))     # Copy, as the caller may keep drawing
+
+    def play(self, effect):
+        self._call(self.display.play(effect))
+
+    def command(self, effect, value=None):
+        self._call(self.display.transport.command(effect, value))
+        if effect != 'brightness': self.loop.call_soon_threadsafe(self.display.filter.reset)    # Display no longer shows our last frame
+
+    def close(self):
+        self._call(self.display.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+async def main(host):
+    """
+    Example: a scroller is preempted by an image after 3 seconds, as a sensor event would do
+    """
+    display = AsyncDisplay(await CoreTransport.connect(host))
+    print("- Connected, protocol version", display.transport.version)
+
+    scroller = asyncio.ensure_future(display.play(scroll_frames("Scrolling is fun!?!", [100, 10, 5], 10)))
+    await asyncio.sleep(3)
+    scroller.cancel()       # Preempting the scroller, e.g. because a sensor fired
+    await display.play(image_frames('images/bell.png', hold=2))
+
+    print("- Sent", display.sent, "frames, dropped", display.dropped, "-", display.filter.summary())
+    await display.close()
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'))
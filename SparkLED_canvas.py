@@ -0,0 +1,130 @@
+""" A virtual canvas of arbitrary size, tiled across several Spark Cores (one LED panel each).
+
+        Each Tile says where its panel sits on the canvas and how the panel is wired. Every tile gets its own
+        CoreTransport, and frames are sent to all tiles concurrently. To keep a scrolling message from tearing at
+        the panel boundaries, frames are presented in two phases when all tiles speak protocol 2: the frame is
+        loaded on every tile with the hold flag, and once every tile has acknowledged it, all of them are told to
+        show it (\x00S) at the same time. Tiles that only speak protocol 1 show frames as they arrive, so the
+        canvas falls back to a barrier: no tile gets the next frame before every tile has shown this one.
+"""
+import asyncio
+import SparkLED_globals as glob
+import SparkLED_protocol as protocol
+from SparkLED_async import AsyncDisplay, CoreTransport, scroll_frames
+from SparkLED_framebuffer import FrameSerializer
+
+
+class Tile:
+    """
+    One LED panel and the Spark Core driving it
+    """
+
+    def __init__(self, host, port=glob.PORT, x=0, y=0, width=16, height=16, serpentine=True,
+                 first_row_reversed=False, bottom_up=False, gamma=glob.GAMMA):
+        """
+        @param host: IP address of the Spark Core
+        @param port: port number of the Spark Core (or emulator)
+        @param x: left edge of the panel on the canvas
+        @param y: top edge of the panel on the canvas
+        @param width: panel width in LEDs
+        @param height: panel height in LEDs
+        @param serpentine: see FrameSerializer
+        @param first_row_reversed: see FrameSerializer
+        @param bottom_up: see FrameSerializer
+        @param gamma: gamma correction of this panel, as panels from different batches rarely match
+        """
+        self.host = host
+        self.port = port
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.wiring = dict(serpentine=serpentine, first_row_reversed=first_row_reversed, bottom_up=bottom_up, gamma=gamma)
+        self.serializer = None
+        self.payload = None         # This panel's part of the canvas's serialized frame
+        self.transport = None
+
+
+class TiledCanvas(AsyncDisplay):
+    """
+    AsyncDisplay for a canvas made of several tiles. present() and play() take frames the size of the whole canvas
+    """
+
+    def __init__(self, width, height, tiles, fps=glob.TARGET_FPS):
+        """
+        @param width: canvas width in LEDs
+        @param height: canvas height in LEDs
+        @param tiles: list of Tile
+        @param fps: maximum frames per second
+        """
+        super().__init__(None, width, height, fps)
+        self.tiles = tiles
+        self.width = width
+        self.height = height
+
+        for tile in tiles:
+            if tile.x < 0 or tile.y < 0 or tile.x + tile.width > width or tile.y + tile.height > height:
+                raise ValueError("Tile at {}:{} does not fit on the {}x{} canvas".format(tile.host, tile.port, width, height))
+            # Each serializer gathers its panel's pixels straight out of the whole canvas - no intermediate copies
+            tile.serializer = FrameSerializer(tile.width, tile.height, x=tile.x, y=tile.y, canvas_width=width, **tile.wiring)
+
+        # The serialized frames of all tiles back to back, so the filter compares what actually goes out to every tile
+        self.wire = bytearray(sum(tile.width * tile.height * 3 for tile in tiles))
+        offset = 0
+        for tile in tiles:
+            tile.payload = memoryview(self.wire)[offset:offset + tile.width * tile.height * 3]
+            offset += len(tile.payload)
+
+    async def connect(self):
+        """
+        Connects to every tile concurrently
+        """
+        transports = await asyncio.gather(*(CoreTransport.connect(tile.host, tile.port) for tile in self.tiles))
+        for tile, transport in zip(self.tiles, transports):
+            tile.transport = transport
+            print("- Connected to tile", tile.host + ":" + str(tile.port), "at", (tile.x, tile.y),
+                  "protocol version", transport.version)
+        return self
+
+    @property
+    def synchronized(self):
+        """
+        True if every tile can hold a frame until told to show it
+        """
+        return all(tile.transport.version >= protocol.PROTOCOL_PIPELINED for tile in self.tiles)
+
+    async def close(self):
+        if self._sender: self._sender.cancel()
+        await asyncio.gather(*(tile.transport.close() for tile in self.tiles))
+
+    def _serialize(self):
+        # Serializing every tile before sending anything, so all tiles get the same frame (each has its own output buffer)
+        for tile in self.tiles: tile.payload[:] = tile.serializer.serialize(self.frame)
+        return self.wire
+
+    async def _transmit(self, data):
+        if self.synchronized:
+            await asyncio.gather(*(tile.transport.send_frame(tile.payload, hold=True) for tile in self.tiles))
+            await asyncio.gather(*(tile.transport.wait_acked() for tile in self.tiles))     # Every tile has the frame loaded
+            await asyncio.gather(*(tile.transport.show() for tile in self.tiles))
+        else:
+            await asyncio.gather(*(tile.transport.send_frame(tile.payload) for tile in self.tiles))
+
+
+async def main(host, ports):
+    """
+    Example: one message scrolling across a row of panels, one emulator per port
+    """
+    tiles = [Tile(host, port, x=16 * n) for n, port in enumerate(ports)]
+    canvas = await TiledCanvas(16 * len(tiles), 16, tiles).connect()
+    print("- Synchronized presentation:", canvas.synchronized)
+
+    await canvas.play(scroll_frames("Scrolling across " + str(len(tiles)) + " panels!", [100, 10, 5], 8, canvas.width))
+
+    print("- Sent", canvas.sent, "frames, dropped", canvas.dropped, "-", canvas.filter.summary())
+    await canvas.close()
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main('127.0.0.1', [int(port) for port in sys.argv[1:]] or [2208, 2209]))
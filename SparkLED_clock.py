@@ -0,0 +1,87 @@
+""" Digital clock for the 16x16 display, hh:mm above dd:MM in the tiny 3x5 font.
+        The digit sprites are built once from the glyph atlas. draw() only redraws the digit cells that changed since
+        the last call and tells the caller whether anything did, so the clock needs one frame a minute in stead of
+        one a second. The clock also works as an overlay layer (see glob.overlays): overlay() draws just the lit
+        pixels of the digits on top of whatever the frame holds.
+"""
+from datetime import datetime
+import numpy as np
+import SparkLED_globals as glob
+from SparkLED_text import colorize, get_atlas
+
+# Screen layout:
+# 16 x 16: we need 3 leds per number, with 1 led in between each, four numbers across: xxx0 xxx0 0xxx 0xxx - in the double zero in the middle we have : or / for presentation
+# Vertically we have 5 lines per number: hh:mm after one blank line, then three blank lines and dd:MM
+CELLS = ((0, 1), (4, 1), (9, 1), (13, 1),      # Hours, minutes
+         (0, 9), (4, 9), (9, 9), (13, 9))      # Day, month
+
+
+class DigitalClock:
+    """
+    Clock component: keeps track of the digits on display and draws only what changed
+    """
+
+    def __init__(self, color, x=0, y=0):
+        """
+        @param color: list [r, g, b]
+        @param x: left edge of the clock on the display
+        @param y: top edge of the clock on the display
+        """
+        mask = get_atlas('numfont3x5').glyphs[1:, :, :3]     # Glyph 1 + digit, without the spacing column
+        self.masks = mask.astype(bool)[..., None]           # (10, 5, 3, 1) - which pixels of each digit are lit
+        self.sprites = colorize(mask, color)                # (10, 5, 3, 3) - one 5x3 RGB sprite per digit
+        self.cells = [(cx + x, cy + y) for cx, cy in CELLS]
+        self.shown = None           # The digits last drawn by draw()
+        self.overlaid = None        # The digits last drawn by overlay()
+
+    @staticmethod
+    def digits(now=None):
+        """
+        @param now: datetime (None -> now)
+        @return: tuple of the 8 digits on display: hh mm dd MM
+        """
+        now = now or datetime.today()
+        return tuple(int(digit) for digit in now.strftime('%H%M%d%m'))
+
+    @staticmethod
+    def seconds_to_change(now=None):
+        """
+        @return: seconds until the next minute starts, when the digits may change
+        """
+        now = now or datetime.today()
+        return 60 - now.second - now.microsecond / 1000000
+
+    def draw(self, frame, now=None, force=False):
+        """
+        Draws the digit cells that changed since the last call (everything the first time, or with force)
+        @param frame: Framebuffer or (height, width, 3) array, holding what the last call drew
+        @param now: datetime (None -> now)
+        @param force: redraw every cell, e.g. when something else has drawn on the frame
+        @return: True if anything was drawn (the frame needs to be sent)
+        """
+        pixels = np.asarray(frame)
+        digits = self.digits(now)
+        changed = False
+        for cell, digit in enumerate(digits):
+            if force or self.shown is None or self.shown[cell] != digit:
+                x, y = self.cells[cell]
+                pixels[y:y + 5, x:x + 3] = self.sprites[digit]
+                changed = True
+        self.shown = digits
+        return changed
+
+    def changed(self, now=None):
+        """
+        @return: True if the overlay shows other digits than the time now
+        """
+        return self.overlaid != self.digits(now)
+
+    def overlay(self, frame, now=None):
+        """
+        Draws the lit pixels of every digit on top of the frame, leaving the rest of the frame alone
+        @param frame: Framebuffer or (height, width, 3) array
+        """
+        pixels = np.asarray(frame)
+        self.overlaid = self.digits(now)
+        for (x, y), digit in zip(self.cells, self.overlaid):
+            np.copyto(pixels[y:y + 5, x:x + 3], self.sprites[digit], where=self.masks[digit])
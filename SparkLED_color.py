@@ -0,0 +1,154 @@
+""" Color handling for SparkLED: lookup tables and whole-frame color transforms.
+        LED brightness is far from linear to the eye: the steps between the low values are big and the ones between
+        the high values are barely visible. A gamma table fixes that, and as a 256 entry lookup table it costs one
+        np.take() per frame. Brightness (dimming, fades) is a table as well, and tables are combined once so the output
+        pipeline never does more than one lookup per frame (see FrameSerializer).
+        The HSV and HLS conversions work on whole arrays of [r, g, b] (a single color, a frame or a stack of frames),
+        in stead of calling colorsys once per pixel.
+"""
+import numpy as np
+
+IDENTITY = np.arange(256, dtype=np.uint8)     # The table that changes nothing
+
+
+def gamma_table(gamma=2.2):
+    """
+    @param gamma: gamma of the LEDs (1.0: no correction)
+    @return: 256 entry uint8 lookup table from color value to LED value
+    """
+    return np.round(255 * (IDENTITY / 255) ** gamma).astype(np.uint8)
+
+
+def brightness_table(brightness):
+    """
+    @param brightness: 0.0 (off) .. 1.0 (unchanged), higher values brighten (clipped at 255)
+    @return: 256 entry uint8 lookup table scaling every color value
+    """
+    return np.clip(np.round(IDENTITY * float(brightness)), 0, 255).astype(np.uint8)
+
+
+def output_table(gamma=1.0, brightness=1.0):
+    """
+    @return: gamma correction and brightness combined into one lookup table (dimming first, then gamma)
+    """
+    return gamma_table(gamma)[brightness_table(brightness)]
+
+
+def apply_table(pixels, table, out=None):
+    """
+    Runs every color value of pixels through a lookup table
+    @param pixels: uint8 array of any shape (e.g. a frame)
+    @param table: 256 entry uint8 lookup table
+    @param out: optional array for the result (may be pixels itself)
+    @return: the transformed array
+    """
+    return np.take(table, np.asarray(pixels), out=out)
+
+
+def fade_tables(steps):
+    """
+    Precomputes the tables for a fade, so each faded frame is one table lookup
+    @param steps: number of steps from full brightness to black
+    @return: (steps + 1, 256) uint8 array, table n has brightness 1 - n / steps
+    """
+    return np.round(np.linspace(1, 0, steps + 1)[:, None] * IDENTITY).astype(np.uint8)
+
+
+def rgb_to_hsv(pixels):
+    """
+    @param pixels: array like of [r, g, b] values 0-255, any shape ending in 3
+    @return: float array of the same shape, [h, s, v] each 0-1
+    """
+    rgb = np.asarray(pixels, dtype=np.float64) / 255
+    high = rgb.max(axis=-1)
+    span = high - rgb.min(axis=-1)
+    hue = _hue(rgb, high, span)
+    saturation = np.divide(span, high, out=np.zeros_like(high), where=high > 0)
+    return np.stack((hue, saturation, high), axis=-1)
+
+
+def hsv_to_rgb(hsv):
+    """
+    @param hsv: array like of [h, s, v], each 0-1, any shape ending in 3
+    @return: uint8 array of the same shape with [r, g, b]
+    """
+    hsv = np.asarray(hsv, dtype=np.float64)
+    hue, saturation, value = hsv[..., 0], hsv[..., 1], hsv[..., 2]
+    # Standard piecewise form: each channel is v minus the part of the chroma that channel is below the hue
+    k = (np.array([5, 3, 1]) + hue[..., None] * 6) % 6
+    rgb = value[..., None] - (value * saturation)[..., None] * np.clip(np.minimum(k, 4 - k), 0, 1)
+    return _to_bytes(rgb)
+
+
+def rgb_to_hls(pixels):
+    """
+    @param pixels: array like of [r, g, b] values 0-255, any shape ending in 3
+    @return: float array of the same shape, [h, l, s] each 0-1 (as colorsys.rgb_to_hls)
+    """
+    rgb = np.asarray(pixels, dtype=np.float64) / 255
+    high = rgb.max(axis=-1)
+    low = rgb.min(axis=-1)
+    span = high - low
+    lightness = (high + low) / 2
+    total = np.where(lightness <= 0.5, high + low, 2 - high - low)
+    saturation = np.divide(span, total, out=np.zeros_like(span), where=span > 0)
+    return np.stack((_hue(rgb, high, span), lightness, saturation), axis=-1)
+
+
+def hls_to_rgb(hls):
+    """
+    @param hls: array like of [h, l, s], each 0-1, any shape ending in 3
+    @return: uint8 array of the same shape with [r, g, b]
+    """
+    hls = np.asarray(hls, dtype=np.float64)
+    hue, lightness, saturation = hls[..., 0], hls[..., 1], hls[..., 2]
+    chroma = (1 - np.abs(2 * lightness - 1)) * saturation
+    k = (np.array([0, 8, 4]) + hue[..., None] * 12) % 12
+    rgb = lightness[..., None] - (chroma / 2)[..., None] * np.clip(np.minimum(k - 3, 9 - k), -1, 1)
+    return _to_bytes(rgb)
+
+
+def get_lightness(pixels):
+    """
+    @return: HLS lightness (0-1) of every [r, g, b] in pixels
+    """
+    rgb = np.asarray(pixels, dtype=np.uint16)
+    return (rgb.max(axis=-1) + rgb.min(axis=-1)) / 510
+
+
+def set_lightness(pixels, lightness):
+    """
+    Sets the HLS lightness of every [r, g, b] in pixels, keeping hue and saturation
+    @param pixels: array like of [r, g, b] values 0-255, any shape ending in 3
+    @param lightness: 0-1, a number or an array broadcasting against pixels.shape[:-1]
+    @return: uint8 array of the same shape
+    """
+    hls = rgb_to_hls(pixels)
+    hls[..., 1] = np.clip(lightness, 0, 1)
+    return hls_to_rgb(hls)
+
+
+def adjust_lightness(pixels, change):
+    """
+    Changes the HLS lightness of every [r, g, b] in pixels relative to its own lightness
+    @param change: -1 .. +1 (-0.5 halves the lightness)
+    @return: uint8 array of the same shape
+    """
+    hls = rgb_to_hls(pixels)
+    hls[..., 1] = np.clip(hls[..., 1] * (1 + change), 0, 1)
+    return hls_to_rgb(hls)
+
+
+def _hue(rgb, high, span):
+    # Hue (0-1) of the [r, g, b] (0-1) in rgb, 0 for grays - the same for HSV and HLS
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    safe = np.where(span > 0, span, 1)
+    hue = np.where(high == red, (green - blue) / safe,
+                   np.where(high == green, 2 + (blue - red) / safe, 4 + (red - green) / safe))
+    return np.where(span > 0, (hue / 6) % 1, 0)
+
+
+def _to_bytes(rgb):
+    # Float [r, g, b] 0-1 to uint8 0-255, truncating like the int(x * 255) of the colorsys code it replaces
+    # (the tiny offset keeps values like 49.99999999 that are 50 on paper from ending up as 49)
+    return (np.clip(rgb, 0, 1) * 255 + 1e-6).astype(np.uint8)
@@ -0,0 +1,124 @@
+""" Priority events for SparkLED, e.g. someone ringing the doorbell.
+        The EventListener holds one long-lived connection to the log server (Tools/logserver.py), subscribed to CRIT
+        messages, which the log server pushes the moment a sensor logs them - there is no polling. Every event is
+        handed to the EventDispatcher, which aborts the running effect at once (see SparkLED_lib.abort(): effects
+        stop at their next frame, and effects waiting for their next frame wake up). The main loop then calls
+        run_pending(), which runs the handler registered for the sensor, e.g. showing an image of a bell.
+        The time from receiving an event until the first frame drawn by its handler is sent is recorded as the
+        'event' stage of SparkLED_stats.
+"""
+from collections import deque, namedtuple
+import socket
+import threading
+from time import perf_counter, sleep
+import SparkLED_globals as glob
+from SparkLED_lib import abort, clear_abort
+from SparkLED_stats import stats
+
+EVENT_PREFIX = 'evt ==> '       # Lines pushed by the log server: evt ==> sensorname:level:value
+
+Event = namedtuple('Event', 'sensor level value received')     # received: perf_counter() when the event arrived
+
+
+class EventDispatcher:
+    """
+    Queues events and preempts the running effect for them. Thread safe
+    """
+
+    def __init__(self):
+        self.handlers = {}          # sensorname -> function(event), None -> handler for every other sensor
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.handled = 0
+
+    def on(self, sensor, handler):
+        """
+        @param sensor: sensor name, or None for the events of every sensor without a handler of its own
+        @param handler: function(event) drawing something and calling present(). It runs in the thread calling
+                        run_pending(), and should return when glob.abort_flag is set (another event has arrived)
+        """
+        self.handlers[sensor] = handler
+
+    def post(self, event):
+        """
+        Queues an event and aborts the running effect, so the main loop gets to run_pending() at once
+        """
+        if event.sensor not in self.handlers and None not in self.handlers: return     # Nobody is interested
+        with self.lock:
+            self.queue.append(event)
+            abort()
+
+    def pending(self):
+        with self.lock:
+            return len(self.queue) > 0
+
+    def run_pending(self):
+        """
+        Runs the handlers of the events waiting, oldest first. Called by the main loop between effects
+        @return: True if any event was handled
+        """
+        handled = False
+        while True:
+            with self.lock:
+                if not self.queue:
+                    if handled: clear_abort()       # The last handler may have been aborted by the last event
+                    return handled
+                event = self.queue.popleft()
+                clear_abort()
+
+            if glob.governor: glob.governor.discard()       # A frame of the preempted effect shouldn't delay ours
+            stats.mark('event', event.received)
+            self.handlers.get(event.sensor, self.handlers.get(None))(event)
+            self.handled += 1
+            handled = True
+
+
+class EventListener:
+    """
+    Subscribes to the priority events of the log server, and keeps reconnecting if the connection is lost
+    """
+
+    def __init__(self, dispatcher, host=glob.LOG_SERVER, port=glob.LOG_SERVER_PORT, retry=glob.EVENT_RETRY):
+        """
+        @param dispatcher: EventDispatcher the events are posted to
+        @param host: host running Tools/logserver.py
+        @param port: port of the log server
+        @param retry: seconds between attempts to reconnect
+        """
+        self.dispatcher = dispatcher
+        self.host = host
+        self.port = port
+        self.retry = retry
+        self.connected = False
+
+    def start(self):
+        thread = threading.Thread(target=self.listen)
+        thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+        thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port), 10) as server:
+                    server.settimeout(None)         # Events come whenever they come
+                    server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)    # Noticing a log server that's gone
+                    server.sendall(b'sub\n')
+                    self.connected = True
+                    print("- Subscribed to events from the log server at", self.host, "on port", self.port)
+
+                    for line in server.makefile('rb'):
+                        received = perf_counter()
+                        line = line.decode(errors='replace').strip()
+                        if not line.startswith(EVENT_PREFIX): continue      # The ack of our sub
+                        try:
+                            sensor, level, value = line[len(EVENT_PREFIX):].split(':', 2)
+                        except ValueError:
+                            print("ERROR: Malformed event from the log server:", line)
+                            continue
+                        self.dispatcher.post(Event(sensor, level, value, received))
+                print("ERROR: The log server closed the connection")
+            except socket.error as error:
+                print("ERROR: Log server connection failed:", format(error))
+            self.connected = False
+            sleep(self.retry)
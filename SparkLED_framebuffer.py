@@ -0,0 +1,247 @@
+""" This module contains the frame buffer used by SparkLED and the functions that work on it.
+        The frame buffer is a contiguous (height, width, 3) uint8 numpy array, so whole-screen
+        operations (fill, blit, slicing) are single vectorized calls in stead of loops over
+        hundreds of small [r, g, b] lists.
+        FrameSerializer converts a frame buffer to the byte order of the LED panel's zigzag wiring.
+        SwapChain hands finished frames from the renderers to the transmit thread without copying or tearing.
+        ScrollCanvas is a wide canvas (e.g. a rendered message) that scrollers show through window views.
+"""
+import threading
+import numpy as np
+import SparkLED_color
+
+
+class Framebuffer:
+    """
+    A (height, width, 3) RGB frame buffer. Pixel (x, y) lives at pixels[y, x].
+    Indexing the Framebuffer directly indexes the underlying array, so fb[3:5, 2] = [255, 0, 0] works
+    """
+
+    def __init__(self, width=16, height=16):
+        """
+        @param width: width of the buffer in pixels
+        @param height: height of the buffer in pixels
+        """
+        self.pixels = np.zeros((height, width, 3), dtype=np.uint8)
+
+    @property
+    def width(self):
+        return self.pixels.shape[1]
+
+    @property
+    def height(self):
+        return self.pixels.shape[0]
+
+    def __getitem__(self, key):
+        return self.pixels[key]
+
+    def __setitem__(self, key, value):
+        self.pixels[key] = value
+
+    def __len__(self):
+        return self.width * self.height     # Number of LEDs, same as len() of the old 256 element list
+
+    def __array__(self, dtype=None, copy=None):
+        return self.pixels if dtype is None else self.pixels.astype(dtype)      # Lets np.asarray(fb) see the pixels directly
+
+    def clear(self):
+        """
+        Sets all pixels to black
+        """
+        self.pixels.fill(0)
+
+    def fill(self, color, x=0, y=0, width=None, height=None):
+        """
+        Fills a rectangle (the whole buffer by default) with a single color
+        @param color: list [r, g, b]
+        @param x: left edge of rectangle
+        @param y: top edge of rectangle
+        @param width: width of rectangle (None -> to the right edge)
+        @param height: height of rectangle (None -> to the bottom edge)
+        """
+        x_end = self.width if width is None else x + width
+        y_end = self.height if height is None else y + height
+        self.pixels[max(y, 0):y_end, max(x, 0):x_end] = color
+
+    def blit(self, source, x=0, y=0):
+        """
+        Copies an image onto the buffer with its top left corner at (x, y), clipping whatever falls outside
+        @param source: Framebuffer or (height, width, 3) array
+        @param x: x coordinate of the top left corner (may be negative)
+        @param y: y coordinate of the top left corner (may be negative)
+        """
+        if isinstance(source, Framebuffer): source = source.pixels
+
+        src_x, src_y = max(-x, 0), max(-y, 0)
+        dst_x, dst_y = max(x, 0), max(y, 0)
+        width = min(source.shape[1] - src_x, self.width - dst_x)
+        height = min(source.shape[0] - src_y, self.height - dst_y)
+        if width <= 0 or height <= 0: return      # Nothing visible
+
+        self.pixels[dst_y:dst_y + height, dst_x:dst_x + width] = source[src_y:src_y + height, src_x:src_x + width]
+
+    def get_pixel(self, x, y):
+        return self.pixels[y, x]
+
+    def put_pixel(self, x, y, color):
+        self.pixels[y, x] = color
+
+    def copy_from(self, other):
+        """
+        Copies the contents of another buffer of the same size into this one without allocating
+        @param other: Framebuffer or (height, width, 3) array
+        """
+        if isinstance(other, Framebuffer): other = other.pixels
+        np.copyto(self.pixels, other)
+
+    def flat(self):
+        """
+        @return: (width * height, 3) view of the buffer in row order, matching the old led_buffer indexing
+        """
+        return self.pixels.reshape(-1, 3)
+
+
+class SwapChain:
+    """
+    Three preallocated frame buffers that are swapped, never copied, between renderers and the transmit thread:
+        back  - the renderers draw into this one (glob.led_buffer)
+        ready - the newest published frame, waiting to be sent
+        front - the frame the transmit thread is sending, which nobody writes to
+    publish() and acquire() only swap references under a lock, so the transmit thread always gets a complete frame.
+    After publishing, the new back buffer starts out as a copy of the published frame, so renderers that only
+    update parts of the screen (like the clock) keep working. Nothing is allocated per frame.
+    """
+
+    def __init__(self, back):
+        """
+        @param back: Framebuffer to use as the first back buffer (normally the current glob.led_buffer)
+        """
+        self.back = back
+        self.ready = Framebuffer(back.width, back.height)
+        self.front = Framebuffer(back.width, back.height)
+        self.fresh = False          # ready holds a frame the transmit thread hasn't taken yet
+        self.lock = threading.Lock()
+
+    def publish(self):
+        """
+        Publishes the back buffer
+        @return: the new back buffer, which the renderer must draw into from now on
+        """
+        with self.lock:
+            self.back, self.ready = self.ready, self.back
+            self.fresh = True
+            self.back.copy_from(self.ready)     # 768 bytes into a preallocated buffer
+        return self.back
+
+    def acquire(self):
+        """
+        Called by the transmit thread to get the newest published frame. The frame stays untouched until the next acquire()
+        @return: the front buffer, or None if nothing was published since the last call
+        """
+        with self.lock:
+            if not self.fresh: return None
+            self.ready, self.front = self.front, self.ready
+            self.fresh = False
+        return self.front
+
+    def drop(self):
+        """
+        Forgets the frame waiting in ready without sending it. No buffers are swapped, so the front buffer the transmit
+        thread may be sending right now never comes back to the renderers
+        """
+        with self.lock:
+            self.fresh = False
+
+
+class ScrollCanvas:
+    """
+    A wide (height, columns, 3) canvas to scroll a display across. window() returns a view of the visible columns,
+    never a copy. With wrap the canvas loops seamlessly: the first columns are appended once up front, so windows
+    crossing the end are plain views as well
+    """
+
+    def __init__(self, pixels, width=16, wrap=False):
+        """
+        @param pixels: (height, columns, 3) array, e.g. from text_to_buffer()
+        @param width: display width in pixels
+        @param wrap: True to loop straight from the last column back to the first
+        """
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        columns = pixels.shape[1]
+        if wrap: pixels = np.concatenate((pixels, np.take(pixels, np.arange(width + 1) % columns, axis=1)), axis=1)
+        elif columns <= width: pixels = np.concatenate((pixels, np.zeros((pixels.shape[0], width + 1 - columns, 3), dtype=np.uint8)), axis=1)
+
+        self.pixels = np.ascontiguousarray(pixels)
+        self.width = width
+        self.positions = columns if wrap else max(columns - width, 1)      # Number of distinct scroll offsets
+
+    def window(self, offset, extra=0):
+        """
+        @param offset: scroll offset in columns (taken modulo the number of positions)
+        @param extra: columns to include beyond the right edge (1 for the column scrolling in next)
+        @return: (height, width + extra, 3) view of the canvas
+        """
+        offset %= self.positions
+        return self.pixels[:, offset:offset + self.width + extra]
+
+
+class FrameSerializer:
+    """
+    Turns a Framebuffer into the bytes the LED panel expects on the wire.
+
+    The serpentine ("zigzag") wiring of the panel is precomputed once as a permutation of pixel indices, so each
+    frame is a single gather into a preallocated output array, one lookup in the panel's output table (gamma
+    correction and brightness, skipped when it changes nothing) and one vectorized clamp of the reserved zero bytes. serialize() returns a memoryview of that output array, which can go straight to socket.sendall().
+    NOTE: the memoryview is reused, so it is only valid until the next call to serialize()
+    """
+
+    def __init__(self, width=16, height=16, serpentine=True, first_row_reversed=False, bottom_up=False,
+                 x=0, y=0, canvas_width=None, gamma=1.0, brightness=1.0):
+        """
+        @param width: panel width in LEDs
+        @param height: panel height in LEDs
+        @param serpentine: True if every second line is wired in the opposite direction of the one before
+        @param first_row_reversed: True if the first line is wired right to left (then lines 0, 2, 4... are reversed)
+        @param bottom_up: True if the first LED is on the bottom line (panel mounted upside down)
+        @param x: left edge of the panel on the canvas it shows a part of
+        @param y: top edge of the panel on the canvas
+        @param canvas_width: width of the canvas frames passed to serialize() (None -> same as the panel)
+        @param gamma: gamma correction for this panel's LEDs (1.0: none)
+        @param brightness: 0.0 .. 1.0, dims the panel (see set_brightness())
+        """
+        self.width = width
+        self.height = height
+
+        if canvas_width is None: canvas_width = width
+        index = (np.arange(y, y + height)[:, None] * canvas_width + np.arange(x, x + width)).astype(np.intp)
+        if bottom_up: index = index[::-1]
+        if first_row_reversed: index[0::2] = index[0::2, ::-1]
+        if serpentine: index[1::2] = index[1::2, ::-1]     # Reversing every second line, *without* reversing the byte values
+        self.permutation = index.ravel()       # permutation[n] is the row order (canvas) pixel index shown by LED number n
+
+        self._output = np.empty((width * height, 3), dtype=np.uint8)
+        self._view = memoryview(self._output).cast('B')
+
+        self.gamma = gamma
+        self.table = None
+        self.set_brightness(brightness)
+
+    def set_brightness(self, brightness):
+        """
+        Dims (or fades) the panel from the next frame on: one table lookup per frame, whatever is drawn
+        @param brightness: 0.0 (off) .. 1.0 (as drawn)
+        """
+        self.brightness = brightness
+        table = SparkLED_color.output_table(self.gamma, brightness)
+        self.table = None if np.array_equal(table, SparkLED_color.IDENTITY) else table
+
+    def serialize(self, frame):
+        """
+        @param frame: Framebuffer or (height, width, 3) array in row order (the whole canvas for panels that show part of one)
+        @return: memoryview of width * height * 3 bytes (R, G, B per LED in wire order), with 0 replaced by 1
+        """
+        pixels = np.asarray(frame).reshape(-1, 3)
+        np.take(pixels, self.permutation, axis=0, out=self._output)
+        if self.table is not None: np.take(self.table, self._output, out=self._output)      # Gamma and brightness
+        np.maximum(self._output, 1, out=self._output)     # Zero is reserved for control codes, 1 is still off on the LED
+        return self._view
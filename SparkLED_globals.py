@@ -2,10 +2,13 @@
 	The objective is to shrink this file as much as possible and use
 	function arguments in stead wherever possible.
 """
+import threading
+from SparkLED_framebuffer import Framebuffer, FrameSerializer
 
 # Global variables
-transmit_flag = False	# Set when we're ready to let the transmit thread tranmit the transmit_buffer, which then unsets flag
+governor = None		# SparkLED_lib.FrameGovernor, hands frames from renderers to the transmit thread (see present())
 abort_flag = None	# Set when we want to terminate connection between server and client. Sets server in listening mode.
+abort_event = threading.Event()	# Set together with abort_flag (see SparkLED_lib.abort()), wakes up effects waiting for their next frame
 connected = False	# Set when client is connected to server
 
 OFFLINE = None		# For debugging: do not transmit transmit_buffer (offline debugging)
@@ -15,6 +18,28 @@ NUM_LEDS = None
 sparkCore = None
 
 PORT = 2208		# Port number to connect to server
+PROTOCOL = 2		# Highest protocol version we ask for (1: stop-and-wait G/A/D, 2: pipelined frames), see SparkLED_protocol.py
+PIPELINE_WINDOW = 4	# Maximum number of frames in flight with protocol 2
+DELTA_FRAMES = True	# Protocol 2: only send the pixels that changed since the previous frame
+COMPRESS_FRAMES = True	# Protocol 2: send run-length encoded or palette indexed frames when they are smaller
+SKIP_DUPLICATES = True	# Don't send frames identical to the one the display already shows
+SIMILAR_THRESHOLD = 0	# Also skip frames differing by at most this much per color value (0-255) while frames are dropped (0: off)
+
+TARGET_FPS = 30		# Maximum frames per second sent to the display
+MAX_LATENCY = 0.1	# Maximum seconds a renderer waits for the transmit thread with the 'block' frame policy
+FRAME_POLICY = 'drop'	# What happens to frames published faster than we can send them: 'drop' or 'block'
+
+STATS_PORT = None	# Local HTTP port serving frame statistics as JSON, see SparkLED_stats.py (None: off), e.g. 8208
+STATS_INTERVAL = 0	# Seconds between frame statistics log lines (0: off)
+
+LOG_SERVER = None	# Host running Tools/logserver.py, which pushes priority events (doorbell etc.) to us (None: off)
+LOG_SERVER_PORT = 2208	# Port of the log server
+EVENT_RETRY = 5		# Seconds between attempts to reconnect to the log server
+
+protocol_version = 1	# The protocol version negotiated with the server in initialize()
+frame_link = None	# SparkLED_protocol.PipelinedSender when protocol 2 is in use
+frame_filter = None	# SparkLED_protocol.FrameFilter for the current connection, skips frames that change nothing
+overlays = []		# Layers drawn on top of every frame sent, e.g. SparkLED_clock.DigitalClock (see transmit_loop())
 
 settings = {
 	'OFFLINE': False,
@@ -22,10 +47,12 @@ settings = {
 	'DEBUG': False
 }
 
-led_buffer = [''] * 256  # The list RGB colors for the LED
-for i in range(256):
-	led_buffer[i] = [0, 0, 0]  # 256 x 3 list
+WIDTH = 16		# Display width in LEDs
+HEIGHT = 16		# Display height in LEDs
+ASSET_CACHE_SIZE = 16 * 1024 * 1024	# Bytes of decoded image frames kept in memory, see SparkLED_assets.py
+GAMMA = 1.0		# Gamma correction of the LED panel (1.0: none, around 2.2 makes fades and dimming look even)
+SCROLL_STEPS = 10	# Frames per pixel when scrolling smoothly (aa=True), see SparkLED_lib.subpixel_frames()
 
-transmit_buffer = [None] * 256  # We need this copy of the led_buffer to avoid overwriting while we do effects and prepare to transmit the data
-for i in range(256):
-	transmit_buffer[i] = [None] * 3
+led_buffer = Framebuffer(WIDTH, HEIGHT)  # The RGB colors for the LEDs, a 16 x 16 x 3 uint8 array. Renderers draw here,
+					# present() swaps it for a new back buffer so the transmit thread never sees half-drawn frames
+serializer = FrameSerializer(WIDTH, HEIGHT, gamma=GAMMA)  # Converts led_buffer to the zigzag byte order (and gamma) of the display
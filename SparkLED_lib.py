@@ -7,171 +7,173 @@
 import curses
 import threading
 from PIL import Image
-import colorsys
 import socket
-from copy import deepcopy
-from time import sleep, time
+from time import sleep, time, monotonic, perf_counter, thread_time
 import random
+import numpy as np
 import SparkLED_globals as glob
+import SparkLED_color
 import SparkLED_data
+import SparkLED_protocol as protocol
+from SparkLED_framebuffer import Framebuffer, SwapChain
+from SparkLED_stats import stats
+from SparkLED_text import render_text
 from sys import exit
 
 
-def anti_alias_left_10(buffer, original_buffer, current_step):      # TODO: Convert to LVS and average, to make it work on non-monochrome
+def convert_buffer(frame=None):
     """
-    Takes one full screen of pixels and scroll them one pixel left with steps using anti-aliasing. Local variables only. No screen updates, only returns buffer.
-    @param original_buffer: the screen buffer, unchanged by this function
-    @param buffer: the screen buffer (normally display_buffer passed as argument)
-    @param current_step: number og intermediate steps to take between pixel fully on and pixel fully off or vice versa
-    @return: the updated screen buffer
+    Compensates for the display's zigzag pattern of LEDs (if LED active) and returns the bytes to transmit
+    Also changes all 0 1 (still off on LED, but we need the 0 to send control codes)
+    The zigzag permutation is precomputed by glob.serializer, so this is a single gather into a reused buffer
+    @param frame: the Framebuffer to convert (None -> glob.led_buffer)
+    @return: memoryview of the RGB led buffer ready to transmit (only valid until the next call)
     """
-    black = [0,0,0]                             # Setting the black pixel color
-    color = [None, None, None]
+    return glob.serializer.serialize(glob.led_buffer if frame is None else frame)
 
-    for pixel in original_buffer:
-            if pixel != [0,0,0]: color = pixel              # Finding the monochrome pixel color
 
-    if color == [None, None, None]: return buffer   # If the whole screen is black, we got nothing to do
+# noinspection PyShadowingNames,PyShadowingNames
+def buffer_to_screen(server, frame=None):
+    """
+    Sends a frame to the Spark Core
+    @param server: Server connection (Spark Core)
+    @param frame: the Framebuffer to send (None -> glob.led_buffer)
+    """
+    start = perf_counter()
+    data = convert_buffer(frame)
+    stats.record('serialize', perf_counter() - start)
 
-    bright = rgb_get_brightness(color)          # Finding the color's default brightness value
+    # Frames that don't change the display are skipped - near-duplicates only while renderers outpace us
+    saturated = glob.governor is not None and glob.governor.pending
+    if glob.frame_filter and not glob.frame_filter.check(data, saturated): return
 
-    #       1)      For each real scrolled pixel we scroll 10 "virtual" pixels (between the real pixels)
-    #       2)      We do this by a range(10) loop where we reduce brightness of the original pixel 10% each time IF AND ONLY IF the pixel to the right is black (we work monochrome here). Else skip to 3)
-    #       3)      Similarly we in the same loop increase the brightness of the pixel to the left by 10% (same color)
-    #       4)      After 10 iterations we have a fully saturated pixel on the left of our original pixel (and black pixel to the right if the real pixel to the right was black) and we exit loop to start
-    #               over again after real pixels have been scrolled one position left
+    if glob.frame_link:     # Pipelined protocol: no per-frame round trips, the link waits only if the window is full
+        try:
+            glob.frame_link.send_frame(data)
+        except socket.error as error:
+            if format(error) == "timed out":
+                connection_lost(server, "ERROR: Timeout waiting for LED server to acknowledge frames")
+            else:
+                connection_lost(server, "ERROR: Connect failed: " + format(error))
+            return
 
-    # TODO: Fix the fact that thereis little *visible* difference between the highest brightness value (non-linear relationship)
+        stats.frame_sent()
+        if glob.DEBUG:
+            print("Display updates:\033[1m", buffer_to_screen.updates, "\033[0m", glob.frame_link.encoder.summary(),
+                  glob.frame_filter.summary() if glob.frame_filter else '', end='\r')
+            buffer_to_screen.updates += 1
+        return
 
-    change = float((current_step + 1) / 10)
+    start = perf_counter()
+    try:
+        server.sendall(b'\x00' + b'G')
+        wait_for_code(server, b'A')
+    except socket.error as error:
+        if format(error) == "timed out":
+            connection_lost(server, "ERROR: Timeout waiting for LED server to acknowledge ('A') having received Go code")
+        else:
+            connection_lost(server, "ERROR: Connect failed: " + format(error))
+        return
 
-    for col in range(15):           # We go line by line - making a single step for all pixels
-            for row in range(16):       # We iterate over each pixel in the visible_line except the last one (it doesn't have anything to the right)
-                    cur_pixel = row * 16 + col
+    #print("DEBUG: 'A' from Spark Core")
 
-                    if original_buffer[cur_pixel + 1] == color and original_buffer[cur_pixel] == black:     # Pixel to the right is ON, and the current isn't --> [[0,0,0], [125,50,0]]
-                            buffer[cur_pixel] = rgb_set_brightness(color, bright * change)                                          # We migrate ON pixel from the right onto this one (if it's already lit -> no change)
+    sent = perf_counter()
+    stats.record('wait_a', sent - start)
+    try:
+        server.sendall(data)
+        start = perf_counter()
+        stats.record('send', start - sent)
+        wait_for_code(server, b'D')
+    except socket.error as error:
+        if format(error) == "timed out":
+            connection_lost(server, "ERROR: Timeout waiting for LED server to send Done ('D') after receiving 768 bytes'")
+        else:
+            connection_lost(server, "ERROR: Connect failed: " + format(error))
+        return
 
-                    if original_buffer[cur_pixel + 1] == black and original_buffer[cur_pixel] == color:             # Pixel to the right is OFF, and the current isn't  --> [[125,50,0], [0,0,0]]
-                            buffer[cur_pixel] = rgb_set_brightness(color, bright * (1 - change))                            # We migrate OFF pixel from the right onto this one (if it's already lit -> no change)
+    #print("DEBUG: 'D' from Spark Core")
 
-    return buffer
+    stats.record('wait_d', perf_counter() - start)
+    stats.frame_sent()
+    if glob.DEBUG:
+        print("Display updates:\033[1m", buffer_to_screen.updates, "\033[0m",
+              glob.frame_filter.summary() if glob.frame_filter else '', end='\r')
+        buffer_to_screen.updates += 1
 
 
-def convert_buffer():
+def wait_for_code(server, code):
     """
-    Compensates for the display's zigzag pattern of LEDs (if LED active) and returns bytearray()
-    Also changes all 0 1 (still off on LED, but we need the 0 to send control codes)
-    @return: updated RGB led buffer ready to transmit
+    Reads from the Spark Core until it sends code (b'A' or b'D')
+    @raise ConnectionResetError: if the Spark Core hangs up in stead
     """
+    while True:
+        answer = server.recv(1)
+        if answer == code: return
+        if not answer: raise ConnectionResetError("Spark Core closed the connection")
 
-    line_buffer = deepcopy(glob.led_buffer)
 
+def connection_lost(server, message):
     """
-        Note, depending on what the LED driver expects, we might need to enable this snippet which reverses every second line
+    Called when the connection to the Spark Core breaks: closes it (ending its transmit thread) and clears
+    glob.connected, so the main loop reconnects. The running effect is aborted, so the main loop gets to do that at once
+    @param message: what went wrong, printed
     """
+    print(message)
+    glob.connected = False
+    close_connection(server)
+    abort()
 
-    # Due to the LEDs on this particular display being in a zigzag pattern, we need to reverse the orientation of
-    # every second line. 1,3,5,7,9,11,13,15 to be precise. But *without* reversing the byte values.
-    # Reversing the zigzag pattern
-    for line in range(1,16,2):  # Every second line from 1 to and including 15
-            for led in range(16 - 1, -1, -1):
-                    line_buffer[(line * 16) + (15 - led)] = glob.led_buffer[line * 16 + led]
-
-    # We convert the whole transmit_buffer list into a string of bytes that we can write to curses/Arduino
-    byte_buffer = bytearray()
-
-    for rgb in line_buffer: # For each led... 256 in total
-            if rgb[0] == 0: rgb[0] = 1      # Zero is reserved for control codes
-            if rgb[1] == 0: rgb[1] = 1
-            if rgb[2] == 0: rgb[2] = 1
-
-
-            byte_buffer.append(rgb[0])  # Red
-            byte_buffer.append(rgb[1])  # Green
-            byte_buffer.append(rgb[2])  # Blue
 
-    return byte_buffer
-
-
-# noinspection PyShadowingNames,PyShadowingNames
-def buffer_to_screen(server):
-    try:
-        server.sendall(b'\x00' + b'G')
-    except:
-        print("- Go code 'G' failed")
-        exit()
-    while True:
-        try:
-            glob.transmit_flag = False
-            if server.recv(1) == b'A': break
-        except socket.error as error:
-            if format(error) == "timed out":
-                print("ERROR: Timeout waiting for LED server to acknowledge ('A') having received Go code")
-            else:
-                print("ERROR: Connect failed:", format(error))
+def close_connection(server):
+    """
+    Closes a Spark Core connection, and wakes its transmit thread, which ends as soon as it sees the socket closed
+    (see transmit_loop()), in stead of waiting for a frame that would go to the next connection
+    """
+    server.close()
+    if glob.governor: glob.governor.discard()       # Wakes the transmit thread, and drops the frame meant for the old connection
 
-            exit(1)
 
-    #print("DEBUG: 'A' from Spark Core")
+def abort():
+    """
+    Stops the running effect: effects loop until glob.abort_flag is set, and wait_or_abort() returns at once
+    """
+    glob.abort_flag = True
+    glob.abort_event.set()
 
-    server.sendall(convert_buffer())
-    glob.transmit_flag = False
 
-    try:
-        while True:
-            if server.recv(1) == b'D': break
-    except socket.error as error:
-            if format(error) == "timed out":
-                print("ERROR: Timeout waiting for LED server to send Done ('D') after receiving 768 bytes'")
-                exit(1)
-            else:
-                print("ERROR: Connect failed:", format(error))
-                exit(1)
+def clear_abort():
+    glob.abort_flag = False
+    glob.abort_event.clear()
 
-    #print("DEBUG: 'D' from Spark Core")
 
-    if glob.DEBUG:
-        print("Display updates:\033[1m", buffer_to_screen.updates, "\033[0m", end='\r')
-        buffer_to_screen.updates += 1
+def wait_or_abort(seconds):
+    """
+    Sleeps like sleep(), but wakes up as soon as abort() is called
+    @return: True if the effect has been aborted
+    """
+    if seconds > 0: return glob.abort_event.wait(seconds)
+    return bool(glob.abort_flag)
 
 
-def effects():
+def effects(frame=None):
     """
     Adds fancy effects and is responsible to compensating for the display's zigzag pattern of LEDs
-    @param glob.led_buffer: the full RGB led buffer
+    @param frame: the Framebuffer to convert (None -> glob.led_buffer). The transmit thread gets an unchanging
+                  frame from the SwapChain, so there is no need to copy it first
     @return: updated RGB led buffer ready to transmit
     """
-    transmit_buffer = deepcopy(glob.led_buffer) # Required, otherwise glob.led_buffer can get modified by other thread while we're working here
-
+    pixels = np.asarray(glob.led_buffer if frame is None else frame).reshape(-1, 3)
 
     """
             Due to the LEDs on this particular display being in a zigzag pattern, we need to reverse the orientation of
             every second line. 1,3,5,7,9,11,13,15 to be precise. But *without* reversing the byte values.
+            The precomputed permutation of glob.serializer does exactly that.
     """
 
-    # Reversing the zigzag pattern
-
-    for line in range(1,16,2):  # Every second line from 1 to and including 15
-            for led in range(16 - 1, -1, -1):
-                    glob.line_buffer[15 - led] = transmit_buffer[line * 16 + led]
-
-            transmit_buffer[line * 16:line * 16 + 16] = glob.line_buffer[0:16]
-
-
-
     #
-    # Finally, we convert the whole transmit_buffer list into a string of bytes that we can write to curses/Arduino
+    # Finally, we convert the whole reordered array into a string of bytes that we can write to curses/Arduino
     #
-    buffer = bytearray()
-
-
-    for rgb in transmit_buffer:          # For each led... 256 in total
-            buffer.append(rgb[0])
-            buffer.append(rgb[1])
-            buffer.append(rgb[2])
-
-    return buffer
+    return bytearray(pixels[glob.serializer.permutation].tobytes())
 
 
 def ext_effect(server, effect, effect_value = None):
@@ -181,30 +183,126 @@ def ext_effect(server, effect, effect_value = None):
     @param effect: Effect name
     @param effect_value: Effect value
     """
-    glob.transmit_flag = 0
-
-    if effect == 'brightness': hw_effect = b'B'
-    if effect == 'hw_test': hw_effect = b'T'
-    if effect == 'blank': hw_effect = b'Z'
+    if glob.governor: glob.governor.discard()
+    if glob.frame_filter and effect != 'brightness': glob.frame_filter.reset()    # The display no longer shows the last frame sent
 
     #if glob.DEBUG: print("\n---> Performing", effect)
 
-    try: server.sendall(b'\x00' + hw_effect)
-    except:
-        print("- Sending of effect code,", hw_effect, "failed")
-        exit()
-
-
-    if effect_value:    # Could be None
-            value_string = bytes([effect_value])
-            #print(value_string)
-            server.sendall(value_string)       # Send the 3 digits as bytes
+    try: server.sendall(protocol.effect_command(effect, effect_value))     # Code and value (if any) in one go
+    except socket.error as error:
+        connection_lost(server, "ERROR: Sending of effect code for " + effect + " failed: " + format(error))
 
     # Since some of these effects can take some time, we wait here until we get 'D'one from the Spark Core
     #while True:
     #		if server.recv(1) == b'D': break
 
 
+class FrameClock:
+    """
+    Paces an effect on absolute deadlines: wait(seconds) sleeps until seconds after the previous deadline, so the time
+    spent rendering and transmitting a frame doesn't add to it, and the effect runs at exactly the speed asked for
+    """
+
+    def __init__(self):
+        self.deadline = monotonic()
+
+    def wait(self, seconds):
+        """
+        @param seconds: time from the previous deadline to the next
+        """
+        self.deadline += seconds
+        now = monotonic()
+        if self.deadline < now - seconds: self.deadline = now    # If we fall far behind (stalled link), we resync in stead of rushing
+        elif self.deadline > now: wait_or_abort(self.deadline - now)     # abort() ends the wait at once
+
+
+class FrameGovernor:
+    """
+    Hands frames from the renderers to the transmit thread, in stead of the transmit thread spinning on a flag.
+
+    Renderers draw into glob.led_buffer and call present(), which publishes the frame through a SwapChain: the
+    transmit thread gets the finished frame by a reference swap, and renderers carry on in another buffer, so
+    there are no copies and no half-updated frames. The transmit thread sleeps in wait_frame() until a frame
+    is published, and never sends more than fps frames per second. If a renderer publishes while the previous frame
+    is still waiting to be sent, the policy decides what happens:
+        'drop'  - the new frame replaces the waiting one (the waiting one is dropped), the renderer never waits
+        'block' - the renderer waits until the waiting frame has been taken, but at most max_latency seconds,
+                  after which the waiting frame is dropped anyway
+    """
+
+    def __init__(self, fps=30, max_latency=0.1, policy='drop', swap_chain=None):
+        """
+        @param fps: maximum frames per second sent to the display
+        @param max_latency: maximum seconds a renderer is blocked waiting for the transmit thread ('block' policy)
+        @param policy: 'drop' or 'block'
+        @param swap_chain: SwapChain the frames are published through (None -> one around glob.led_buffer)
+        """
+        if policy not in ('drop', 'block'):
+            print("ERROR: Frame policy must be 'drop' or 'block', not", policy)
+            exit(1)
+
+        self.fps = fps
+        self.max_latency = max_latency
+        self.policy = policy
+        self.swap_chain = swap_chain if swap_chain else SwapChain(glob.led_buffer)
+
+        self.condition = threading.Condition()
+        self.pending = False            # A published frame is waiting to be sent
+        self.next_send = 0              # Earliest time (monotonic()) the next frame may be sent
+
+        self.published = 0              # Frames published by renderers
+        self.sent = 0                   # Frames handed to the transmit thread
+        self.dropped = 0                # Frames replaced before they were sent
+
+    def publish(self):
+        """
+        Called by renderers when the back buffer (glob.led_buffer) holds a finished frame
+        @return: the new back buffer to draw into
+        """
+        with self.condition:
+            if self.pending and self.policy == 'block':
+                self.condition.wait_for(lambda: not self.pending, self.max_latency)
+
+            if self.pending: self.dropped += 1
+            back = self.swap_chain.publish()
+            self.pending = True
+            self.published += 1
+            self.condition.notify_all()
+        return back
+
+    def discard(self):
+        """
+        Drops a published frame that hasn't been sent yet (e.g. before sending a command to the Spark Core)
+        """
+        with self.condition:
+            if self.pending: self.swap_chain.drop()     # Forgetting the frame, front may still be in the transmit thread's hands
+            self.pending = False
+            self.condition.notify_all()
+
+    def wait_frame(self, timeout=None, stop=None):
+        """
+        Called by the transmit thread: waits for a published frame, then waits until the frame rate cap allows sending it
+        @param timeout: maximum seconds to wait for a frame (None -> forever)
+        @param stop: optional function returning True when the caller must give up, e.g. because its connection was
+                     closed. Checked whenever the governor wakes up, so call discard() after making it True
+        @return: the Framebuffer to send, which stays unchanged until the next call, or None on timeout or stop
+        """
+        stopped = stop if stop else lambda: False
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending or stopped(), timeout) or stopped(): return None
+
+        delay = self.next_send - monotonic()
+        if delay > 0: sleep(delay)      # Frames published while we sleep just replace the pending one
+
+        with self.condition:
+            if not self.pending or stopped(): return None        # Discarded, or stopped, while we were sleeping
+            self.pending = False
+            self.sent += 1
+            self.next_send = max(self.next_send + 1 / self.fps, monotonic())   # Fixed rate, without building up a backlog
+            self.condition.notify_all()
+            return self.swap_chain.acquire()
+
+
 def get_line(x1, y1, x2, y2):
     """
     Bresenham's Line Algorithm
@@ -255,7 +353,7 @@ def get_pixel(x, y):
     @param y: y coordinate (0-15)
     @param color: list [r, g, b]
     """
-    return glob.led_buffer[x + y * 16]
+    return glob.led_buffer.get_pixel(x, y)
 
 
 def init_thread(thread_function, *args):
@@ -282,6 +380,15 @@ def pure_pil_alpha_to_color_v2(image, color=(255, 255, 255)):
     return background
 
 
+def present():
+    """
+    Publishes glob.led_buffer as a finished frame to the transmit thread. glob.led_buffer is then swapped for
+    another buffer (holding a copy of the frame), so always draw through glob.led_buffer, never a saved reference to it
+    """
+    stats.rendered(thread_time())      # CPU time the renderer spent on this frame
+    if glob.governor: glob.led_buffer = glob.governor.publish()
+
+
 def put_line(x1, y1, x2, y2):
     for coordinate in get_line(x1,y1,x2,y2):
             put_pixel(coordinate[0], coordinate[1], [255,0,0])
@@ -294,51 +401,36 @@ def put_pixel(x, y, color):
     @param y: y coordinate (0-15)
     @param color: list [r, g, b]
     """
-    glob.led_buffer[x + y * 16] = color
+    glob.led_buffer.put_pixel(x, y, color)
 
 
 def rgb_adjust_brightness(rgb_values, bright_change):
     """
-    Adjusts "lightness" of r,g,b values
+    Adjusts "lightness" of r,g,b values (works on whole frames too, see SparkLED_color.adjust_lightness())
     @param rgb_values: list of [r, g, b]
     @param bright_change: change in brightness (-1 .. +1)
     @return: rgb_values: list of [r, g, b]
     """
-    hls_values = list(colorsys.rgb_to_hls(rgb_values[0] / 255, rgb_values[1] / 255, rgb_values[2] / 255))
-
-    hls_values[1] = hls_values[1] + bright_change * hls_values[1]
-    if hls_values[1] > 1: hls_values[1] = 1
-    if hls_values[1] < 0: hls_values[1] = 0
-
-    rgb_values = list(colorsys.hls_to_rgb(hls_values[0], hls_values[1], hls_values[2]))
-    rgb_values = [int(x * 255) for x in rgb_values]            # Converting from 0-1 (float) to 0-255 (int)
-    return rgb_values
+    return SparkLED_color.adjust_lightness(rgb_values, bright_change).tolist()
 
 
 def rgb_get_brightness(rgb_values):
-    hls_values = list(colorsys.rgb_to_hls(rgb_values[0] / 255, rgb_values[1] / 255, rgb_values[2] / 255))
-    return hls_values[1]
+    return float(SparkLED_color.get_lightness(rgb_values))
 
 
 def rgb_set_brightness(rgb_values, brightness):
     """
-    Adjusts "lightness" of r,g,b values
+    Adjusts "lightness" of r,g,b values (works on whole frames too, see SparkLED_color.set_lightness())
     @param rgb_values: list of [r, g, b]
     @param brightness: brightness (0-1)
     @return: rgb_values: list of [r, g, b]
     """
-    hls_values = list(colorsys.rgb_to_hls(rgb_values[0] / 255, rgb_values[1] / 255, rgb_values[2] / 255))
-
-    hls_values[1] = brightness
-
-    rgb_values = list(colorsys.hls_to_rgb(hls_values[0], hls_values[1], hls_values[2]))
-    rgb_values = [int(x * 255) for x in rgb_values]            # Converting from 0-1 (float) to 0-255 (int)
-    return rgb_values
+    return SparkLED_color.set_lightness(rgb_values, brightness).tolist()
 
 
 # noinspection PyUnusedLocal,PyUnusedLocal,PyShadowingNames
 def signal_handler(signal, frame):
-    glob.transmit_flag = False
+    if glob.governor: glob.governor.discard()
     print('\n- Interrupted manually, aborting')
 
     ext_effect(glob.sparkCore, 'blank')
@@ -352,63 +444,45 @@ def signal_handler(signal, frame):
     print("Exiting...")
     exit(0)
 
+
+def subpixel_frames(window, steps=None, out=None):
+    """
+    Smooth scrolling for any content (multi-color text, images): the frames between the visible window and the window
+    one pixel further left, each pixel a linear blend of itself and its right hand neighbour. One vectorized
+    computation per pixel scrolled, in stead of per-pixel color conversions on every intermediate step
+    @param window: (height, width + 1, 3) array - the visible columns plus the column scrolling in from the right
+    @param steps: number of frames per pixel scrolled (1: no smoothing, None -> glob.SCROLL_STEPS)
+    @param out: optional (steps, height, width, 3) uint8 array to fill, in stead of allocating a new one
+    @return: (steps, height, width, 3) uint8 array, frame k scrolled k / steps pixel left (frame 0 is the window itself)
+    """
+    if steps is None: steps = glob.SCROLL_STEPS
+    window = np.asarray(window, dtype=np.uint16)
+    current, following = window[None, :, :-1], window[None, :, 1:]
+    weights = np.arange(steps, dtype=np.uint16)[:, None, None, None]      # How far each frame has moved towards the next pixel
+
+    blend = (current * (steps - weights) + following * weights + steps // 2) // steps    # Rounded, 255 * steps fits in uint16
+    if out is None: return blend.astype(np.uint8)
+    np.copyto(out, blend, casting='unsafe')
+    return out
+
+
 def text_to_buffer(display_text, red, green, blue):
     """
     Creates a buffer (in display_buffer) that contains the full text
-    @rtype : length of text string (letters)
+    @rtype : length of text string (letters), (16, 16 * letters, 3) array with the text
     @param display_text: The text we will put in the display_buffer (which can be of arbitrary size, unlike the glob.led_buffer (which is always 16*16*3)
     @param red: red value (0-255)
     @param green: green value (0-255)
     @param blue: blue value (0-255)
     """
 
-    font = SparkLED_data.font1
-
     # We "cheat" by adding a padding space at the beginning and end, which will allow us to smoothly scroll the last letter off the screen
     # with a 16x16 font and the first onto the screen
     display_text = " " + display_text + " "
 
-    # We now build a large array of our text
-    letter_counter = 0
-
-    # We use 16 (one for each line) bytearrays to store the letter, and add new ones at the end
-    msg_buffer = [bytearray()] * 16     # List of 16 bytearrays
-
-    for letter in display_text:  # Letter loop
-            font_index = (ord(letter) - 32) * 32    # ASCII - 32 is start of our fonts, and each font is 32 bytes (256 bits/monochrome pixels)
-            text_buffer = font[font_index:(font_index + 32)]
-
-            for line in range(16):    # Line loop
-                    msg_buffer[line] = msg_buffer[line] + text_buffer[line * 2: (line * 2) + 2]
-
-            letter_counter += 1
-
-
-    # msg_buffer is a LIST of bytearrays, each of 2 bytes
-
-    display_buffer = []
-
-    for msg_line in msg_buffer:             # Each element in the msg_buffer is a bytearray line
-            for pixel in msg_line:
-            # First we split each byte of pixels into separate pixels and adds a 1 or 0 three times (since we later will add 3 colors to each LED)
-                    for bin_pos in range(8):
-                            first = pixel >> 7 - bin_pos
-                            first &= 0x01
-                            display_buffer.append([first] * 3)    # 1 or 0 is added 3 times to make it easier to add colors later
-
-
-    # display_buffer is a list of lists, each inner list consisting of 3 ints, each of these 1 or 0
-
-    # We iterate through the display_buffer. We can cheat, as we know each letter in the standard for is 16x16 pixels (with plenty of space on both side).
-    # Thus we simply remove the two first and last colums for each letter.
+    # The glyphs are decoded once into an atlas, so this is one gather of glyph columns and one multiplication by the color
     # TODO: Remove columns here to reduce space between letters
-
-    # We can now multiply all the inner lists with the right color values
-
-    for led in display_buffer:
-            led[0] *= red
-            led[1] *= green
-            led[2] *= blue
+    display_buffer = render_text(display_text, [red, green, blue])
 
     return len(display_text), display_buffer
 
@@ -417,28 +491,21 @@ def transmit_loop(server):  # TODO: Reinitialize the connection if the keep-aliv
     """
     The main LED update loop that runs perpetually.
 
-    An important aspect is the transmit_loop.start variable, which is a local persistent variable that counts the seconds between each execution
-    This allows us to cap the frame rate in order to avoid drowning the Spark Core in requests.
-    Similarly the transmit_loop.idle variable checks how long since we last transmitted something, and if the time is more that 10 seconds, we
+    The loop sleeps on glob.governor until a renderer publishes a frame with present(), so it uses no CPU while
+    idle. The governor also caps the frame rate (glob.TARGET_FPS) in order to avoid drowning the Spark Core in requests.
+    The transmit_loop.idle variable checks how long since we last transmitted something, and if the time is more that 10 seconds, we
     send a keep-alive to the Spark Core to avoid a network timeout.
 
+    Overlay layers in glob.overlays (anything with overlay(frame) and changed() methods, like the DigitalClock) are
+    drawn on top of a copy of each frame. While there are overlays, we wake up every second, and re-send the last frame
+    if an overlay has changed, so e.g. a clock keeps ticking on top of a still image.
     """
+    base = Framebuffer(glob.WIDTH, glob.HEIGHT)        # The last frame from the renderers, without overlays
+    composite = Framebuffer(glob.WIDTH, glob.HEIGHT)   # The frame with the overlays drawn on top
+    have_frame = False
+    closed = lambda: server.fileno() < 0      # True once close_connection() has closed the socket (lost or replaced)
 
     while True:
-        if type(glob.led_buffer[0][0]) is not int: glob.transmit_flag = 0     # We skip if the glob.led_buffer is not ready yet
-
-        # try: transmit_loop.start                        # Time since last iteration (persistent variable)
-        # except: transmit_loop.start = time()            # First iteration, assigning current time to variable
-        #
-        # try: transmit_loop.idle                         # Time since last transmission (persistent variable)
-        # except: transmit_loop.idle = time()            # First iteration, assigning current time to variable
-        #
-        # if time() - transmit_loop.start < 0.0033:        # We cap transfers at about 30 frames/second
-        #     #print("DEBUG: Too quick. Time elapsed since last: " + str('{0:.10f}'.format(time() - transmit_loop.start)))
-        #     #print(".", end='')
-        #     glob.transmit_flag = 0                      # We simply avoid calling buffer_to_screen() until enough time has passed
-        #     transmit_loop.start = time()                    # Resetting execution timer
-
         """
         if time() - transmit_loop.idle > 10:            # We have been idle for 10 seconds or more
             print("\nDEBUG: Idle for 10 seconds, sending keep-alive to Spark Core")
@@ -448,18 +515,30 @@ def transmit_loop(server):  # TODO: Reinitialize the connection if the keep-aliv
                 except ConnectionResetError:
                     print("DEBUG: Lost connection")
                     glob.connected = False
-                    glob.transmit_flag = 0
+                    glob.governor.discard()
                     break
                 if time() - transmit_loop.idle > 15:    # We haven't received an acknowledge for 5 seconds (10 + 5)
                     print("ERROR: Connection with Spark Core timed out")
                     glob.connected = False
-                    glob.transmit_flag = 0
+                    glob.governor.discard()
                 if answer == b'D': break
                 transmit_loop.idle = time()                 # Resetting idle timer every time we send a screen update
         """
 
-        if glob.transmit_flag:
-            glob.transmit_flag = 0                      # Make sure we don't end up sending several times on top of eachother
-                                                                                                    # Means we must actively set glob.transmit_flag = 1 in outside code
-            #transmit_loop.start = time()                # Resetting exceution timer
-            buffer_to_screen(server)
+        # Blocks until a frame is published and the frame rate cap allows sending it, or the connection is closed
+        frame = glob.governor.wait_frame(1 if glob.overlays else None, stop=closed)
+        if closed(): return     # close_connection(): the main loop reconnects and starts a new transmit thread
+
+        if not glob.overlays:
+            if frame is not None: buffer_to_screen(server, frame)
+            continue
+
+        if frame is not None:
+            base.copy_from(frame)
+            have_frame = True
+        elif not have_frame or not any(layer.changed() for layer in glob.overlays):
+            continue
+
+        composite.copy_from(base)
+        for layer in glob.overlays: layer.overlay(composite)
+        buffer_to_screen(server, composite)
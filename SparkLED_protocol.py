@@ -0,0 +1,561 @@
+""" This module contains the network protocol spoken between SparkLED (client) and the Spark Core (server).
+        It is shared with Tools/led_server_emulator.py, so the client and the emulator agree on the byte layout.
+
+        Protocol 1 (stop-and-wait, what the Spark Core firmware speaks):
+            client: \x00G   server: A   client: 768 bytes   server: D
+            Two network round trips per frame, which caps the frame rate on Wi-Fi.
+
+        Protocol 2 (pipelined):
+            client: \x00F + kind (1 byte) + sequence (2 bytes) + payload length (2 bytes) + payload
+            server: a + sequence (2 bytes) - cumulative ack: every frame up to and including sequence is shown
+            The client keeps up to a window of frames in flight and never waits for a round trip unless the window is full.
+            Frames are full keyframes, deltas against the previous frame, run-length encoded or palette indexed,
+            whichever is smallest (see FrameEncoder).
+            Frames with the KIND_HOLD flag are loaded but only shown on \x00S, so several Cores can show a frame together.
+
+        Negotiation happens at the \x00K handshake: the client sends \x00K followed by the pair \x00<version>.
+        A server that understands it answers A, then V<version> with the highest version both sides speak.
+        The Spark Core firmware acks \x00K with A and ignores the unknown (\x00, version) command pair, so
+        if no V arrives the client falls back to protocol 1.
+"""
+from collections import deque
+import select
+import socket
+import struct
+import threading
+from time import perf_counter
+import numpy as np
+
+PROTOCOL_STOP_AND_WAIT = 1
+PROTOCOL_PIPELINED = 2
+PROTOCOL_MAX = PROTOCOL_PIPELINED       # Highest version this module speaks
+
+FRAME_CODE = b'F'
+FRAME_HEADER = struct.Struct('>2sBHH')  # b'\x00F', kind, sequence, payload length
+KIND_RAW = 0                            # Payload is the full serialized frame (768 bytes on a 16x16 display)
+KIND_DELTA_PIXELS = 1                   # Payload is count (2 bytes), then count x (LED index (2 bytes), r, g, b)
+KIND_DELTA_SPANS = 2                    # Payload is count (2 bytes), then count x (first LED (2 bytes), LEDs (2 bytes), r, g, b...)
+
+DELTA_COUNT = struct.Struct('>H')
+DELTA_PIXEL = np.dtype([('index', '>u2'), ('rgb', 'u1', 3)])
+DELTA_SPAN = struct.Struct('>HH')
+
+KIND_RLE = 3                            # Payload is runs of (count, r, g, b): count LEDs in a row with the same color
+KIND_PALETTE = 4                        # Payload is colors (1 byte), colors x (r, g, b), then a 4 bit palette index per LED
+
+RLE_RUN = np.dtype([('count', 'u1'), ('rgb', 'u1', 3)])
+RLE_MAX_RUN = 255
+PALETTE_MAX = 16                        # 4 bit indexes
+CHEAP_DELTA = 64                        # A delta this small (bytes) is sent as it is, without trying RLE or palette frames
+
+KIND_HOLD = 0x80                        # Flag on the kind: load the frame, but don't show it until SHOW_CODE arrives
+SHOW_CODE = b'S'                        # \x00S: show the held frame - lets several Cores switch frames at the same time
+
+KIND_NAMES = {KIND_RAW: 'raw', KIND_DELTA_PIXELS: 'delta pixels', KIND_DELTA_SPANS: 'delta spans',
+              KIND_RLE: 'rle', KIND_PALETTE: 'palette'}
+
+ACK_CODE = b'a'
+ACK = struct.Struct('>cH')              # b'a', sequence of the newest frame shown
+SEQUENCE = struct.Struct('>H')
+VERSION_CODE = b'V'
+
+SEQUENCE_MODULO = 1 << 16               # Sequence numbers wrap around at 16 bits
+
+EFFECT_CODES = {'brightness': b'B', 'hw_test': b'T', 'blank': b'Z'}     # External effects the Spark Core performs itself
+
+
+def hello(version):
+    """
+    @param version: highest protocol version the client wants to speak
+    @return: the bytes the client sends to open a connection (\x00K followed by the version pair)
+    """
+    if version <= PROTOCOL_STOP_AND_WAIT: return b'\x00K'      # Exactly what the original client sent
+    return b'\x00K\x00' + bytes([version])
+
+
+def handshake(server, version):
+    """
+    Opens the conversation on a connected socket: \x00K (with the version pair), waits for the A, then negotiates
+    @param server: connected socket
+    @param version: highest protocol version the client wants to speak
+    @return: protocol version to use
+    """
+    server.sendall(hello(version))
+    while True:
+        data = server.recv(1)
+        if not data: raise ConnectionResetError("Server closed the connection")
+        if data == b'A': break
+    return negotiate(server, version)
+
+
+def effect_command(effect, value=None):
+    """
+    @param effect: 'brightness', 'hw_test' or 'blank' (see EFFECT_CODES)
+    @param value: effect value, e.g. brightness 0-255 (None for effects without a value)
+    @return: the bytes telling the Spark Core to perform the effect
+    """
+    return b'\x00' + EFFECT_CODES[effect] + (bytes([value]) if value is not None else b'')
+
+
+def pack_frame(buffer, kind, sequence, payload):
+    """
+    Builds a protocol 2 frame in a buffer, header and payload together, so they go out in one send
+    @param buffer: bytearray with room for FRAME_HEADER.size + len(payload) bytes
+    @return: memoryview of the frame in buffer
+    """
+    length = len(payload)
+    FRAME_HEADER.pack_into(buffer, 0, b'\x00' + FRAME_CODE, kind, sequence, length)
+    buffer[FRAME_HEADER.size:FRAME_HEADER.size + length] = payload
+    return memoryview(buffer)[:FRAME_HEADER.size + length]
+
+
+def sequence_after(sequence, reference):
+    """
+    @return: True if sequence is newer than reference, allowing for wrap around
+    """
+    distance = (sequence - reference) % SEQUENCE_MODULO
+    return 0 < distance < SEQUENCE_MODULO // 2
+
+
+class FrameEncoder:
+    """
+    Encodes serialized frames for protocol 2, sending each frame in whichever format is smallest:
+        - a full keyframe (KIND_RAW)
+        - a delta against the previous frame: changed pixels or changed spans of LEDs
+        - a run-length encoded frame (KIND_RLE), good for large single color areas like text on black
+        - a palette indexed frame (KIND_PALETTE) with 4 bits per LED, for frames with 16 or fewer colors
+
+    Deltas are tried first, as they are cheap to find. RLE and palette frames are only tried when there is no
+    reference frame or the delta is bigger than CHEAP_DELTA, and the palette (the costly np.unique) only when the
+    best frame so far is bigger than the smallest possible palette frame.
+    The delta reference is the last frame handed to the link. The link is a single ordered TCP stream, so the server
+    has applied every earlier frame by the time a delta reaches it. A new connection gets a new encoder, and the
+    first frame it sends is never a delta.
+    The encoder counts frames per kind, bytes before and after encoding and time spent encoding, see summary(), which
+    may be called from another thread (e.g. SparkLED_stats' HTTP server).
+    """
+
+    def __init__(self, delta=True, compress=True):
+        """
+        @param delta: False to never send deltas
+        @param compress: False to never send RLE or palette frames
+        """
+        self.delta = delta
+        self.compress = compress
+        self.reference = None
+
+        self.frames = {}            # Frames sent, per kind
+        self.bytes_in = 0           # Size of the serialized frames
+        self.bytes_out = 0          # Size of the payloads we actually sent
+        self.encode_time = 0        # Seconds spent encoding
+        self.lock = threading.Lock()    # Guards the counters, summary() reads them all at once
+
+    def reset(self):
+        """
+        Forgets the reference frame, so the next frame is not sent as a delta
+        """
+        self.reference = None
+
+    def reset_counters(self):
+        """
+        Starts the counters over (e.g. between benchmark runs). The reference frame stays
+        """
+        with self.lock:
+            self.frames = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.encode_time = 0
+
+    def encode(self, frame):
+        """
+        @param frame: serialized frame (bytes-like, 3 bytes per LED in wire order)
+        @return: (kind, payload) to hand to PipelinedSender.send()
+        """
+        start = perf_counter()
+        kind, payload = self._encode(frame)
+
+        elapsed = perf_counter() - start
+        with self.lock:
+            self.encode_time += elapsed
+            self.frames[kind] = self.frames.get(kind, 0) + 1
+            self.bytes_in += len(frame)
+            self.bytes_out += len(payload)
+        return kind, payload
+
+    def summary(self):
+        """
+        @return: one line with compression ratio, average encoding time and frames per kind
+        """
+        with self.lock:
+            counts, bytes_in, bytes_out, encode_time = dict(self.frames), self.bytes_in, self.bytes_out, self.encode_time
+        frames = sum(counts.values())
+        if not frames: return "no frames encoded"
+        kinds = ", ".join(KIND_NAMES[kind] + ": " + str(count) for kind, count in sorted(counts.items()))
+        return "ratio {:.2f}, {:.0f} us/frame ({})".format(bytes_out / bytes_in, encode_time / frames * 1e6, kinds)
+
+    def _encode(self, frame):
+        current = np.frombuffer(frame, dtype=np.uint8)
+        pixels = current.reshape(-1, 3)
+        candidates = [(len(current), KIND_RAW, None)]
+
+        if self.delta and self.reference is not None and len(self.reference) == len(current):
+            different = current != self.reference
+            changed = np.flatnonzero(different[0::3] | different[1::3] | different[2::3])     # LEDs with any color changed
+            candidates.append((DELTA_COUNT.size + DELTA_PIXEL.itemsize * len(changed), KIND_DELTA_PIXELS, changed))
+
+            if candidates[-1][0] > CHEAP_DELTA:
+                starts, ends = changed_spans(changed)
+                span_size = DELTA_COUNT.size + DELTA_SPAN.size * len(starts) + 3 * int((ends - starts).sum())
+                candidates.append((span_size, KIND_DELTA_SPANS, (starts, ends)))
+
+        best = min(candidate[0] for candidate in candidates)
+        if self.compress and best > CHEAP_DELTA:
+            runs = color_runs(pixels)
+            candidates.append((RLE_RUN.itemsize * len(runs[0]), KIND_RLE, runs))
+            best = min(best, candidates[-1][0])
+
+            if best > 1 + 3 + (len(pixels) + 1) // 2:      # A palette frame with a single color could still be smaller
+                keys = (pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2]
+                colors, indexes = np.unique(keys, return_inverse=True)
+                if len(colors) <= PALETTE_MAX:
+                    candidates.append((1 + 3 * len(colors) + (len(pixels) + 1) // 2, KIND_PALETTE, (colors, indexes)))
+
+        if self.reference is None or len(self.reference) != len(current): self.reference = current.copy()
+        else: np.copyto(self.reference, current)
+
+        size, kind, data = min(candidates, key=lambda candidate: candidate[0])
+
+        if kind == KIND_DELTA_PIXELS:
+            delta = np.empty(len(data), dtype=DELTA_PIXEL)
+            delta['index'] = data
+            delta['rgb'] = pixels[data]
+            return kind, DELTA_COUNT.pack(len(data)) + delta.tobytes()
+
+        if kind == KIND_DELTA_SPANS:
+            payload = bytearray(DELTA_COUNT.pack(len(data[0])))
+            for start, end in zip(*data):
+                payload += DELTA_SPAN.pack(start, end - start)
+                payload += current[start * 3:end * 3].tobytes()
+            return kind, payload
+
+        if kind == KIND_RLE:
+            run_starts, run_lengths = data
+            runs = np.empty(len(run_starts), dtype=RLE_RUN)
+            runs['count'] = run_lengths
+            runs['rgb'] = pixels[run_starts]
+            return kind, runs.tobytes()
+
+        if kind == KIND_PALETTE:
+            colors, indexes = data
+            palette = np.empty((len(colors), 3), dtype=np.uint8)
+            palette[:, 0], palette[:, 1], palette[:, 2] = colors >> 16, colors >> 8, colors     # Truncated to 8 bits by the uint8 array
+            nibbles = np.zeros(len(pixels) + len(pixels) % 2, dtype=np.uint8)     # Even length: an odd last LED pairs with 0
+            nibbles[:len(pixels)] = indexes.ravel()
+            packed = (nibbles[0::2] << 4) | nibbles[1::2]      # Two LEDs per byte, first LED in the high nibble
+            return kind, bytes([len(colors)]) + palette.tobytes() + packed.tobytes()
+
+        return KIND_RAW, frame     # Keyframe: nothing else is smaller than the frame itself
+
+
+class FrameFilter:
+    """
+    Skips frames that wouldn't change what the display shows, before they cost a handshake or a frame on the link:
+        - duplicates: exactly the frame sent last (static images, the clock, GIFs with repeated frames)
+        - near-duplicates: frames where no byte differs more than threshold from the frame sent last, but only
+          while the link is saturated (the caller says so), as they would delay frames that do matter
+    The comparison is against the last frame sent, not the last one acknowledged: the link is a single ordered stream,
+    so a sent frame is shown before anything sent after it. A new connection needs a new filter (or reset()).
+    """
+
+    def __init__(self, duplicates=True, threshold=0):
+        """
+        @param duplicates: False to send duplicate frames anyway
+        @param threshold: largest byte difference (0 - 255) counted as the same frame when saturated (0: off)
+        """
+        self.duplicates = duplicates
+        self.threshold = threshold
+        self.reference = None       # Copy of the last frame sent
+
+        self.passed = 0             # Frames let through
+        self.skipped = 0            # Duplicates skipped
+        self.skipped_similar = 0    # Near-duplicates skipped
+
+    def reset(self):
+        self.reference = None
+
+    def check(self, frame, saturated=False):
+        """
+        @param frame: serialized frame (bytes-like) or a contiguous uint8 array
+        @param saturated: True if newer frames are already waiting, so near-duplicates may be skipped
+        @return: True if the frame should be sent (it then becomes the reference), False to skip it
+        """
+        pixels = np.frombuffer(frame, dtype=np.uint8)
+
+        if self.reference is not None and len(self.reference) == len(pixels):
+            if self.duplicates and np.array_equal(pixels, self.reference):
+                self.skipped += 1
+                return False
+            if saturated and self.threshold and \
+                    np.abs(pixels.astype(np.int16) - self.reference).max() <= self.threshold:
+                self.skipped_similar += 1
+                return False     # The reference stays, so small changes can't add up unnoticed
+
+        self.reference = pixels.copy()
+        self.passed += 1
+        return True
+
+    def summary(self):
+        """
+        @return: one line with the frames skipped
+        """
+        return "skipped {} duplicate, {} similar of {} frames".format(self.skipped, self.skipped_similar,
+                                                                      self.passed + self.skipped + self.skipped_similar)
+
+
+def color_runs(pixels):
+    """
+    Finds runs of identical neighbouring LEDs, with no run longer than 255 LEDs (the RLE count is one byte)
+    @param pixels: (LEDs, 3) array in wire order
+    @return: (starts, lengths) arrays, one entry per run
+    """
+    flat = pixels.reshape(-1)
+    neighbours = flat[3:] != flat[:-3]
+    different = np.flatnonzero(neighbours[0::3] | neighbours[1::3] | neighbours[2::3]) + 1
+    starts = np.concatenate(([0], different))
+    lengths = np.diff(np.concatenate((starts, [len(pixels)])))
+
+    if lengths.max() > RLE_MAX_RUN:         # Splitting long runs into several of at most RLE_MAX_RUN LEDs
+        pieces = (lengths + RLE_MAX_RUN - 1) // RLE_MAX_RUN
+        run = np.repeat(np.arange(len(starts)), pieces)
+        piece = np.arange(len(run)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        starts = starts[run] + piece * RLE_MAX_RUN
+        lengths = np.minimum(lengths[run] - piece * RLE_MAX_RUN, RLE_MAX_RUN)
+
+    return starts, lengths
+
+
+def changed_spans(changed):
+    """
+    Groups changed LED indexes into spans of neighbouring LEDs. Spans with a single unchanged LED between them
+    are merged, since resending that LED (3 bytes) is cheaper than a new span header (4 bytes)
+    @param changed: sorted array of changed LED indexes
+    @return: (starts, ends) arrays, each span covering LEDs start up to but not including end
+    """
+    if not len(changed): return changed, changed
+
+    breaks = np.flatnonzero(np.diff(changed) > 2)      # A gap of more than one unchanged LED starts a new span
+    starts = changed[np.concatenate(([0], breaks + 1))]
+    ends = changed[np.concatenate((breaks, [len(changed) - 1]))] + 1
+    return starts, ends
+
+
+def decode_frame(kind, payload, frame):
+    """
+    Applies a protocol 2 frame to the frame the server is currently showing (server side of FrameEncoder)
+    @param kind: frame kind, see KIND_* (without the KIND_HOLD flag)
+    @param payload: frame payload
+    @param frame: uint8 numpy array with the current serialized frame, updated in place
+    @return: False if the frame could not be decoded
+    """
+    if kind == KIND_RAW:
+        if len(payload) != len(frame): return False
+        frame[:] = np.frombuffer(payload, dtype=np.uint8)
+        return True
+
+    if kind == KIND_DELTA_PIXELS:
+        count, = DELTA_COUNT.unpack_from(payload)
+        pixels = np.frombuffer(payload, dtype=DELTA_PIXEL, count=count, offset=DELTA_COUNT.size)
+        frame.reshape(-1, 3)[pixels['index'].astype(np.intp)] = pixels['rgb']
+        return True
+
+    if kind == KIND_DELTA_SPANS:
+        count, = DELTA_COUNT.unpack_from(payload)
+        offset = DELTA_COUNT.size
+        for _ in range(count):
+            start, length = DELTA_SPAN.unpack_from(payload, offset)
+            offset += DELTA_SPAN.size
+            frame[start * 3:(start + length) * 3] = np.frombuffer(payload, dtype=np.uint8, count=length * 3, offset=offset)
+            offset += length * 3
+        return True
+
+    if kind == KIND_RLE:
+        runs = np.frombuffer(payload, dtype=RLE_RUN)
+        if int(runs['count'].sum(dtype=np.uint32)) * 3 != len(frame): return False
+        frame.reshape(-1, 3)[:] = np.repeat(runs['rgb'], runs['count'], axis=0)
+        return True
+
+    if kind == KIND_PALETTE:
+        colors = payload[0]
+        palette = np.frombuffer(payload, dtype=np.uint8, count=colors * 3, offset=1).reshape(-1, 3)
+        packed = np.frombuffer(payload, dtype=np.uint8, offset=1 + colors * 3)
+        indexes = np.empty(len(packed) * 2, dtype=np.uint8)
+        indexes[0::2], indexes[1::2] = packed >> 4, packed & 0x0F
+        frame.reshape(-1, 3)[:] = palette[indexes[:len(frame) // 3]]
+        return True
+
+    return False
+
+
+class AckWindow:
+    """
+    Client side bookkeeping of protocol 2, without any I/O, shared by PipelinedSender and SparkLED_async.CoreTransport:
+    numbers the frames, picks the cumulative acks out of whatever the server sends (any other byte, like the D answering
+    a brightness command, is skipped) and tells how many frames are in flight.
+    """
+
+    def __init__(self, window=4, stats=None):
+        """
+        @param window: maximum number of frames in flight
+        @param stats: optional object with a record(stage, seconds) method (SparkLED_stats.stats), which gets the ack latency
+        """
+        self.window = window
+        self.stats = stats
+        self.next_sequence = 0
+        self.acked = SEQUENCE_MODULO - 1        # "Frame -1" is acknowledged, so nothing is in flight
+        self._received = bytearray()
+        self._sent_at = deque()                 # (sequence, perf_counter()) of the frames in flight, for ack latency
+
+    def in_flight(self):
+        return (self.next_sequence - 1 - self.acked) % SEQUENCE_MODULO
+
+    def full(self):
+        return self.in_flight() >= self.window
+
+    def next(self):
+        """
+        Numbers a frame about to be sent
+        @return: its sequence number
+        """
+        sequence = self.next_sequence
+        self.next_sequence = (sequence + 1) % SEQUENCE_MODULO
+        if self.stats: self._sent_at.append((sequence, perf_counter()))
+        return sequence
+
+    def feed(self, data):
+        """
+        Processes bytes received from the server
+        @return: True if any frames were acknowledged
+        """
+        self._received += data
+        acked = self.acked
+        while self._received:
+            if self._received[0:1] != ACK_CODE:
+                del self._received[0]           # Not an ack (e.g. 'D' after an effect), skip it
+                continue
+            if len(self._received) < ACK.size: break        # Rest of the ack hasn't arrived yet
+            _, sequence = ACK.unpack_from(self._received)
+            del self._received[:ACK.size]
+            if sequence_after(sequence, self.acked): self.acked = sequence
+
+        now = perf_counter()
+        while self._sent_at and not sequence_after(self._sent_at[0][0], self.acked):     # Acked, ack latency is known
+            self.stats.record('ack', now - self._sent_at.popleft()[1])
+        return self.acked != acked
+
+
+class PipelinedSender:
+    """
+    Client side of protocol 2 over a blocking socket. Sends self-framed, sequence numbered frames and keeps at most
+    window frames waiting for acknowledgement (see AckWindow). Acks are cumulative, so one ack from the server
+    releases every older frame.
+    """
+
+    def __init__(self, server, window=4, max_payload=768, encoder=None, stats=None):
+        """
+        @param server: connected socket
+        @param window: maximum number of frames in flight (1 behaves like stop-and-wait without the G/A round trip)
+        @param max_payload: size of the largest payload we will send, used to preallocate the send buffer
+        @param encoder: FrameEncoder used by send_frame() (None -> always send keyframes)
+        @param stats: optional object with a record(stage, seconds) method (SparkLED_stats.stats), which gets the
+                      time spent in the 'send', 'window' (waiting for room in the window) and 'ack' stages
+        """
+        self.server = server
+        self.encoder = encoder if encoder else FrameEncoder(delta=False, compress=False)
+        self.stats = stats
+        self.acks = AckWindow(window, stats)
+        self._buffer = bytearray(FRAME_HEADER.size + max_payload)
+        self._window_wait = 0
+
+    def in_flight(self):
+        return self.acks.in_flight()
+
+    def send(self, payload, kind=KIND_RAW):
+        """
+        Sends one frame, first waiting for acks if the window is full
+        @param payload: bytes-like frame data (normally the memoryview from convert_buffer())
+        @param kind: frame kind, see KIND_* (optionally with the KIND_HOLD flag)
+        @return: the sequence number of the frame
+        """
+        if self.acks.full():
+            start = perf_counter()
+            while self.acks.full():
+                self.poll(block=True)
+            self._window_wait = perf_counter() - start
+            if self.stats: self.stats.record('window', self._window_wait)
+
+        if FRAME_HEADER.size + len(payload) > len(self._buffer):
+            self._buffer = bytearray(FRAME_HEADER.size + len(payload))
+
+        sequence = self.acks.next()
+        self.server.sendall(pack_frame(self._buffer, kind, sequence, payload))
+        self.poll()             # Picking up any acks that have arrived, without waiting
+        return sequence
+
+    def send_frame(self, frame):
+        """
+        Encodes and sends one serialized frame
+        @param frame: serialized frame (normally the memoryview from convert_buffer())
+        @return: the sequence number of the frame
+        """
+        start = perf_counter()
+        self._window_wait = 0
+        kind, payload = self.encoder.encode(frame)
+        sequence = self.send(payload, kind)
+        if self.stats: self.stats.record('send', perf_counter() - start - self._window_wait)
+        return sequence
+
+    def poll(self, block=False):
+        """
+        Reads and processes acks from the server
+        @param block: wait (up to the socket timeout) for at least some data if nothing is available
+        """
+        if not block and not select.select([self.server], [], [], 0)[0]: return
+
+        data = self.server.recv(256)
+        if not data: raise ConnectionResetError("Server closed the connection")
+        self.acks.feed(data)
+
+    def drain(self):
+        """
+        Waits until every frame sent has been acknowledged
+        """
+        while self.in_flight():
+            self.poll(block=True)
+
+
+def negotiate(server, version, timeout=1):
+    """
+    Waits for the server to answer the version pair sent by hello()
+    @param server: connected socket, which has already received the A acking \x00K
+    @param version: the version we asked for
+    @param timeout: how long to wait for the V answer before assuming the server only speaks protocol 1
+    @return: protocol version to use
+    """
+    if version <= PROTOCOL_STOP_AND_WAIT: return PROTOCOL_STOP_AND_WAIT
+
+    previous_timeout = server.gettimeout()
+    server.settimeout(timeout)
+    answer = b''
+    try:
+        while len(answer) < 2:
+            data = server.recv(2 - len(answer))
+            if not data: break
+            answer += data
+            if answer[0:1] != VERSION_CODE: answer = b''        # Skipping anything that isn't our answer
+    except socket.timeout:
+        pass
+    finally:
+        server.settimeout(previous_timeout)
+
+    if len(answer) < 2: return PROTOCOL_STOP_AND_WAIT      # Original firmware: silently ignored the version pair
+    return min(answer[1], version)
@@ -0,0 +1,222 @@
+""" Frame statistics for SparkLED: where does the time go, on the render host, the network or the Spark Core?
+        Every stage of a frame is timed into a latency histogram:
+            render      - CPU time the renderer spent on the frame (between two present() calls, sleeping excluded)
+            serialize   - converting the frame buffer to wire order (FrameSerializer)
+            wait_a      - protocol 1: sending \x00G until the Spark Core answers A
+            send        - protocol 1: sending the 768 bytes, protocol 2: encoding and sending the frame
+            wait_d      - protocol 1: from the last byte sent until the Spark Core answers D (it has shown the frame)
+            window      - protocol 2: time blocked because the window of frames in flight was full
+            ack         - protocol 2: from sending a frame until the Spark Core acknowledges it
+            event       - from receiving a priority event (SparkLED_events.py) until the first frame it draws is sent
+        plus the achieved frame rate and counters for frames sent, dropped and skipped, and reconnects.
+        serve() publishes all of it as JSON on a local HTTP port, and log_periodically() prints a summary line.
+"""
+from bisect import bisect_left
+from collections import deque
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, perf_counter, sleep
+import SparkLED_globals as glob
+
+STAGES = ('render', 'serialize', 'wait_a', 'send', 'wait_d', 'window', 'ack', 'event')
+BUCKETS = [0.00001 * 2 ** n for n in range(22)]     # Upper bounds in seconds: 10 us, 20 us ... about 21 s, then overflow
+
+
+class Histogram:
+    """
+    Latency histogram with exponential buckets, so recording is a binary search and one increment
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, percent):
+        """
+        @param percent: 0 - 100
+        @return: upper bound (seconds) of the bucket holding the percentile, or the max for the overflow bucket
+        """
+        if not self.count: return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank: return min(BUCKETS[bucket], self.max) if bucket < len(BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1000,
+                'p90_ms': self.percentile(90) * 1000,
+                'p99_ms': self.percentile(99) * 1000,
+                'max_ms': self.max * 1000,
+                'buckets_ms': {'{:g}'.format(bound * 1000): count for bound, count in zip(BUCKETS, self.counts) if count}}
+
+
+class Stats:
+    """
+    Histograms per stage, counters and frame rate. Thread safe
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.counters = {'frames': 0, 'reconnects': 0}
+        self.frame_times = deque(maxlen=120)        # When the most recent frames were sent, for the frame rate
+        self.started = monotonic()
+        self.marks = []                              # (stage, perf_counter() at the start), ended by the next frame sent
+        self._render = threading.local()             # CPU time of each renderer thread at its last present()
+
+    def reset(self):
+        """
+        Starts over: empties the histograms and counters (e.g. between benchmark runs)
+        """
+        with self.lock:
+            self.stages = {stage: Histogram() for stage in STAGES}
+            self.counters = {'frames': 0, 'reconnects': 0}
+            self.frame_times.clear()
+            self.started = monotonic()
+
+    def record(self, stage, seconds):
+        """
+        @param stage: one of STAGES (or any other name, which gets a histogram of its own)
+        @param seconds: time the stage took
+        """
+        with self.lock:
+            if stage not in self.stages: self.stages[stage] = Histogram()
+            self.stages[stage].add(seconds)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def frame_sent(self):
+        with self.lock:
+            self.counters['frames'] += 1
+            self.frame_times.append(monotonic())
+            if self.marks:
+                now = perf_counter()
+                for stage, start in self.marks:
+                    if stage not in self.stages: self.stages[stage] = Histogram()
+                    self.stages[stage].add(now - start)
+                self.marks.clear()
+
+    def mark(self, stage, start):
+        """
+        Times a stage that ends when the next frame is sent, e.g. from a doorbell event until its frame is on its way.
+        A frame that was already being sent ends it too, so it can come out one frame time short
+        @param start: perf_counter() when the stage started
+        """
+        with self.lock:
+            self.marks.append((stage, start))
+
+    def rendered(self, cpu_time):
+        """
+        Called by present() with the renderer thread's CPU time (time.thread_time()), records the render stage
+        """
+        last = getattr(self._render, 'last', None)
+        if last is not None: self.record('render', cpu_time - last)
+        self._render.last = cpu_time
+
+    def fps(self):
+        """
+        @return: frames sent per second, over the last frames (0 if nothing was sent for a second)
+        """
+        with self.lock:
+            if len(self.frame_times) < 2 or monotonic() - self.frame_times[-1] > 1: return 0.0
+            return (len(self.frame_times) - 1) / max(self.frame_times[-1] - self.frame_times[0], 1e-6)
+
+    def snapshot(self):
+        """
+        @return: dict with everything we know, ready for json.dumps()
+        """
+        fps = self.fps()
+        with self.lock:
+            data = {'uptime': monotonic() - self.started,
+                    'fps': fps,
+                    'counters': dict(self.counters),
+                    'stages': {stage: histogram.as_dict() for stage, histogram in self.stages.items() if histogram.count}}
+
+        data['protocol'] = glob.protocol_version
+        if glob.governor:
+            data['governor'] = {'published': glob.governor.published, 'sent': glob.governor.sent, 'dropped': glob.governor.dropped}
+        if glob.frame_filter:
+            data['filter'] = {'passed': glob.frame_filter.passed, 'skipped': glob.frame_filter.skipped,
+                              'skipped_similar': glob.frame_filter.skipped_similar}
+        if glob.frame_link:
+            data['encoder'] = glob.frame_link.encoder.summary()
+        return data
+
+    def summary(self):
+        """
+        @return: one log line: frame rate, drops and the mean and p90 of each stage
+        """
+        data = self.snapshot()
+        dropped = data.get('governor', {}).get('dropped', 0)
+        skipped = data.get('filter', {}).get('skipped', 0) + data.get('filter', {}).get('skipped_similar', 0)
+        stages = ", ".join("{} {:.2f}/{:.2f}".format(stage, values['mean_ms'], values['p90_ms'])
+                           for stage, values in data['stages'].items())
+        return "{:.1f} fps, {} frames, {} dropped, {} skipped, {} reconnects | ms mean/p90: {}".format(
+            data['fps'], data['counters']['frames'], dropped, skipped, data['counters']['reconnects'], stages)
+
+
+stats = Stats()
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ('/', '/stats'):
+            self.send_error(404)
+            return
+        body = json.dumps(stats.snapshot(), indent=1).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass        # Not cluttering the terminal with a line per request
+
+
+def serve(port, host='127.0.0.1'):
+    """
+    Serves the statistics as JSON on http://host:port/stats from a daemon thread
+    @param port: HTTP port, e.g. glob.STATS_PORT
+    @return: the HTTPServer (call shutdown() to stop it), or None if the port can't be used
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), _StatsHandler)
+    except OSError as error:     # Statistics are nice to have, not a reason to stop the display
+        print("ERROR: Cannot serve frame statistics on port", port, "-", format(error))
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+    thread.start()
+    return server
+
+
+def log_periodically(interval=glob.STATS_INTERVAL):
+    """
+    Prints the summary line every interval seconds, from a daemon thread
+    """
+    def log():
+        while True:
+            sleep(interval)
+            print("\nSTATS:", stats.summary())
+
+    thread = threading.Thread(target=log)
+    thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+    thread.start()
@@ -0,0 +1,189 @@
+""" Text rendering for SparkLED, using glyph atlases.
+        Each font in SparkLED_data.py is decoded once (on first use) into a (glyphs, height, width) array of 1 and 0,
+        so rendering a message is one gather of cached glyph columns plus one vectorized multiplication by the color,
+        in stead of unpacking every letter bit by bit on every call. Rendering time is linear in the message length.
+
+        Ticker is a fixed size ring buffer of pixel columns for unbounded scrolling text: producers append text at any
+        time (also while it scrolls), and the scroller consumes columns. Memory use doesn't grow with the message.
+"""
+from collections import deque
+import threading
+import numpy as np
+import SparkLED_data
+import SparkLED_globals as glob
+
+
+class GlyphAtlas:
+    """
+    All the glyphs of one font as a (glyphs, height, width) uint8 array of 1 and 0, and a table mapping byte values
+    (ASCII) to glyph numbers. Characters the font doesn't have are rendered as the blank glyph
+    """
+
+    def __init__(self, glyphs, characters, blank=0, spacing=0):
+        """
+        @param glyphs: (glyphs, height, width) array of 1 and 0
+        @param characters: string with the character of each glyph, in order
+        @param blank: glyph number used for characters the font doesn't have
+        @param spacing: blank columns added after each glyph when rendering
+        """
+        if spacing:
+            glyphs = np.concatenate((glyphs, np.zeros(glyphs.shape[:2] + (spacing,), dtype=np.uint8)), axis=2)
+
+        self.glyphs = np.ascontiguousarray(glyphs, dtype=np.uint8)
+        self.lookup = np.full(256, blank, dtype=np.intp)
+        for number, character in enumerate(characters):
+            self.lookup[ord(character)] = number
+
+    @property
+    def height(self):
+        return self.glyphs.shape[1]
+
+    @property
+    def width(self):
+        return self.glyphs.shape[2]
+
+    def render(self, text):
+        """
+        @param text: the text to render
+        @return: (height, width * len(text)) uint8 array of 1 and 0, glyphs side by side
+        """
+        codes = np.frombuffer(text.encode('latin-1', 'replace'), dtype=np.uint8)
+        columns = self.glyphs[self.lookup[codes]]                   # (letters, height, width)
+        return columns.transpose(1, 0, 2).reshape(self.height, -1)
+
+
+def _decode_font1():
+    # 16x16 font, 2 bytes per line for each character, starting at ASCII 32 (space)
+    data = np.frombuffer(SparkLED_data.font1, dtype=np.uint8).reshape(-1, 16, 2)
+    characters = ''.join(chr(32 + n) for n in range(len(data)))
+    return GlyphAtlas(np.unpackbits(data, axis=2), characters)
+
+
+def _decode_font5x5():
+    # 8 bytes per character (one per line, 8 pixels wide), with the 5x5 glyph in lines 1-5 and pixels 1-5
+    data = np.frombuffer(SparkLED_data.font5x5, dtype=np.uint8).reshape(-1, 8, 1)
+    glyphs = np.unpackbits(data, axis=2)[:, 1:6, 1:6]
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    glyphs = np.concatenate((np.zeros((1, 5, 5), dtype=np.uint8), glyphs, glyphs[:26]))   # Blank, a-z, 0-9, A-Z
+    return GlyphAtlas(glyphs, ' ' + letters + '0123456789' + letters.upper(), spacing=1)
+
+
+def _decode_numfont3x5():
+    # 5 bytes per digit (one per line), the 3 lowest bits being the pixels
+    data = np.frombuffer(SparkLED_data.numfont3x5, dtype=np.uint8).reshape(-1, 5, 1)
+    glyphs = (data >> np.array([2, 1, 0], dtype=np.uint8)) & 1
+    glyphs = np.concatenate((np.zeros((1, 5, 3), dtype=np.uint8), glyphs))      # Blank, 0-9
+    return GlyphAtlas(glyphs, ' 0123456789', spacing=1)
+
+
+_decoders = {'font1': _decode_font1, 'font5x5': _decode_font5x5, 'numfont3x5': _decode_numfont3x5}
+_atlases = {}
+
+
+def get_atlas(font='font1'):
+    """
+    @param font: 'font1' (16x16), 'font5x5' (letters and digits) or 'numfont3x5' (digits)
+    @return: the GlyphAtlas of the font, decoded on first use
+    """
+    if font not in _atlases: _atlases[font] = _decoders[font]()
+    return _atlases[font]
+
+
+def colorize(mask, color):
+    """
+    @param mask: array of 1 and 0
+    @param color: list [r, g, b]
+    @return: mask.shape + (3,) uint8 array, color where mask is 1 and black elsewhere
+    """
+    return mask[..., None] * np.array(color, dtype=np.uint8)
+
+
+def render_text(text, color, font='font1'):
+    """
+    @param text: the text to render
+    @param color: list [r, g, b]
+    @param font: see get_atlas()
+    @return: (font height, columns, 3) uint8 array with the text
+    """
+    return colorize(get_atlas(font).render(text), color)
+
+
+class Ticker:
+    """
+    Ring buffer of rendered pixel columns. append() queues text (from any thread), which is rendered into the ring
+    as room becomes available. The scroller copies the visible window with window() and moves on with advance().
+    Only the ring (capacity columns) and the text not yet rendered are kept, no matter how long the ticker runs.
+    """
+
+    def __init__(self, capacity=256, font='font1'):
+        """
+        @param capacity: number of columns in the ring buffer (must be at least a display width plus one glyph)
+        @param font: see get_atlas()
+        """
+        self.font = font
+        self.atlas = get_atlas(font)
+        if capacity < glob.WIDTH + self.atlas.width:     # Otherwise a glyph may never fit next to the visible window
+            raise ValueError("Ticker capacity {} is less than the display width {} plus one glyph ({} columns)".format(
+                capacity, glob.WIDTH, self.atlas.width))
+        self.capacity = capacity
+        self.ring = np.zeros((self.atlas.height, capacity, 3), dtype=np.uint8)
+        self.start = 0              # Ring index of the first (leftmost) column
+        self.count = 0              # Columns rendered and not yet scrolled past
+        self.pending = deque()      # (text, color) waiting to be rendered
+        self.lock = threading.Lock()
+
+    def append(self, text, color):
+        """
+        Adds text to the end of the ticker, without disturbing what is already scrolling
+        @param text: the text to add
+        @param color: list [r, g, b]
+        """
+        with self.lock:
+            self.pending.append((text, color))
+            self._fill()
+
+    def available(self):
+        """
+        @return: number of columns left to scroll, counting text that isn't rendered yet
+        """
+        with self.lock:
+            return self.count + sum(len(text) for text, color in self.pending) * self.atlas.width
+
+    def window(self, out):
+        """
+        Copies the leftmost columns into out, black where the ticker has run dry
+        @param out: (height, width, 3) array (e.g. the pixels of a Framebuffer)
+        """
+        width = out.shape[1]
+        with self.lock:
+            shown = min(width, self.count)
+            first = min(shown, self.capacity - self.start)     # Columns before we wrap around the end of the ring
+            out[:, :first] = self.ring[:, self.start:self.start + first]
+            out[:, first:shown] = self.ring[:, :shown - first]
+            out[:, shown:] = 0
+
+    def advance(self, columns=1):
+        """
+        Scrolls columns off the left edge, making room for more text
+        """
+        with self.lock:
+            columns = min(columns, self.count)
+            self.start = (self.start + columns) % self.capacity
+            self.count -= columns
+            self._fill()
+
+    def _fill(self):
+        # Renders as much pending text as fits in the free part of the ring (called with the lock held)
+        while self.pending:
+            letters = (self.capacity - self.count) // self.atlas.width
+            if not letters: return
+
+            text, color = self.pending.popleft()
+            if len(text) > letters: self.pending.appendleft((text[letters:], color))
+            columns = render_text(text[:letters], color, self.font)
+
+            end = (self.start + self.count) % self.capacity
+            first = min(columns.shape[1], self.capacity - end)
+            self.ring[:, end:end + first] = columns[:, :first]
+            self.ring[:, :columns.shape[1] - first] = columns[:, first:]
+            self.count += columns.shape[1]
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# __author__ = 'olesk'
+
+#
+#   Benchmark suite for SparkLED. Starts a headless emulator on localhost (or uses a running emulator or Spark Core
+#   with --host/--port) and runs standard workloads end to end through the real pipeline - present(), FrameGovernor,
+#   transmit_loop() and buffer_to_screen() - with both protocols: a static image, GIF playback, scrolling text with
+#   and without anti-aliasing, and the clock. Workloads run as fast as the link takes frames (capped at --fps).
+#   Micro-benchmarks time the hot paths on their own.
+#
+#   Everything is reported as JSON (stdout, or --output), so runs can be compared by numbers:
+#       codecs      - frame kinds checked to decode to the frame encoded, per LED count (a failure stops the run)
+#       micro       - microseconds per call, best of several runs
+#       workloads   - per protocol and workload: frames presented and sent per second, dropped and skipped frames,
+#                     client CPU microseconds per frame sent, and latency percentiles for every stage (SparkLED_stats.py)
+#
+#   Example: python3 benchmark.py --seconds 5 --output before.json
+#
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+from time import monotonic, process_time, sleep
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))    # SparkLED lives one level up
+import numpy as np
+from PIL import Image
+import SparkLED_globals as glob
+import SparkLED_lib as lib
+import SparkLED_protocol as protocol
+import SparkLED_assets as assets
+import SparkLED_color as color
+from SparkLED_clock import DigitalClock
+from SparkLED_framebuffer import ScrollCanvas
+from SparkLED_stats import stats
+
+EMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'led_server_emulator.py')
+TEXT = "Scrolling is fun!?!"
+ASSETS = None       # (png path, gif path), see make_assets()
+
+
+def make_assets(directory):
+    """
+    Writes the test images, so every run uses the same content: a colorful still and a 30 frame animation
+    @return: (png path, gif path)
+    """
+    y, x = np.mgrid[0:16, 0:16]
+    still = np.stack((x * 16, y * 16, (x + y) * 8), axis=-1).astype(np.uint8)
+    png = os.path.join(directory, 'still.png')
+    Image.fromarray(still).save(png)
+
+    frames = [Image.fromarray(np.roll(still, n, axis=1)).convert('P') for n in range(30)]
+    gif = os.path.join(directory, 'animation.gif')
+    frames[0].save(gif, save_all=True, append_images=frames[1:], duration=40, loop=0)
+    return png, gif
+
+
+def time_call(function, repeat=5):
+    """
+    @return: microseconds per call, best of repeat runs
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def micro_benchmarks():
+    """
+    Times the hot paths on their own, no network involved
+    @return: dict of name -> microseconds per call
+    """
+    rng = np.random.default_rng(0)
+    glob.led_buffer.copy_from(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8))
+    frame = np.array(glob.led_buffer)
+    letters, display_buffer = lib.text_to_buffer(TEXT, 100, 10, 5)
+    window = display_buffer[:, 40:57]
+    steps = np.zeros((glob.SCROLL_STEPS, 16, 16, 3), dtype=np.uint8)
+
+    encoder = protocol.FrameEncoder()
+    frames = [bytes(lib.convert_buffer())]
+    glob.led_buffer[3:5, 2:9] = [255, 0, 0]
+    frames.append(bytes(lib.convert_buffer()))
+    toggle = [0]
+
+    def encode():       # Alternating between two frames, so every frame is a delta
+        toggle[0] ^= 1
+        encoder.encode(frames[toggle[0]])
+
+    frame_filter = protocol.FrameFilter()
+
+    return {'convert_buffer': time_call(lib.convert_buffer),
+            'text_to_buffer': time_call(lambda: lib.text_to_buffer(TEXT, 100, 10, 5)),
+            'subpixel_frames': time_call(lambda: lib.subpixel_frames(window, glob.SCROLL_STEPS, steps)),   # Replaced anti_alias_left_10()
+            'rgb_set_brightness': time_call(lambda: lib.rgb_set_brightness([100, 10, 5], 0.3)),
+            'rgb_get_brightness': time_call(lambda: lib.rgb_get_brightness([100, 10, 5])),
+            'rgb_adjust_brightness': time_call(lambda: lib.rgb_adjust_brightness([100, 10, 5], -0.5)),
+            'set_lightness_frame': time_call(lambda: color.set_lightness(frame, 0.3)),
+            'frame_encoder_delta': time_call(encode),
+            'frame_filter': time_call(lambda: frame_filter.check(frames[0])),
+            'asset_cache_hit': time_call(lambda: assets.cache.get(ASSETS[1]))}
+
+
+def check_codecs(led_counts=(256, 255, 17, 1)):
+    """
+    Encodes frames meant to come out as every frame kind, for even and odd LED counts (panels of any size), and checks
+    that decode_frame() gives back the frame that was encoded
+    @return: dict of LED count -> frame kinds checked
+    """
+    rng = np.random.default_rng(0)
+    checked = {}
+    for leds in led_counts:
+        colors = rng.integers(1, 256, (16, 3), dtype=np.uint8)
+        runs = np.repeat(colors[:2], [leds // 2, leds - leds // 2], axis=0)
+        changed = runs.copy()
+        changed[::max(leds // 3, 1)] = colors[5]
+        frames = [rng.integers(1, 256, (leds, 3), dtype=np.uint8),    # Noise: keyframe
+                  colors[rng.integers(0, 16, leds)],                  # 16 colors all over: palette
+                  runs,                                               # Two runs: RLE
+                  changed]                                            # A few LEDs changed: delta
+
+        encoder = protocol.FrameEncoder()
+        shown = np.zeros(leds * 3, dtype=np.uint8)      # What the server shows
+        kinds = set()
+        for frame in frames:
+            kind, payload = encoder.encode(frame.tobytes())
+            if not protocol.decode_frame(kind, bytes(payload), shown) or shown.tobytes() != frame.tobytes():
+                sys.exit("ERROR: {} frame of {} LEDs doesn't decode to the frame encoded".format(protocol.KIND_NAMES[kind], leds))
+            kinds.add(protocol.KIND_NAMES[kind])
+        checked[str(leds)] = sorted(kinds)
+    return checked
+
+
+def start_emulator(port):
+    """
+    Starts a headless emulator and waits until it listens
+    @return: the emulator process
+    """
+    process = subprocess.Popen([sys.executable, EMULATOR, '--headless', '--port', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()      # The emulator shrugs off this empty connection
+            return process
+        except OSError:
+            sleep(0.1)
+    process.kill()
+    sys.exit("ERROR: The emulator didn't start listening on port " + str(port))
+
+
+def connect(host, port, version, fps, policy):
+    """
+    Connects like SparkLED.initialize() does, and starts a transmit thread with a new FrameGovernor
+    @return: the socket
+    """
+    server = socket.create_connection((host, port), 10)
+    server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    glob.protocol_version = protocol.handshake(server, version)
+    glob.frame_filter = protocol.FrameFilter(glob.SKIP_DUPLICATES, glob.SIMILAR_THRESHOLD)
+    glob.frame_link = None
+    if glob.protocol_version >= protocol.PROTOCOL_PIPELINED:
+        glob.frame_link = protocol.PipelinedSender(server, glob.PIPELINE_WINDOW, stats=stats,
+                                                   encoder=protocol.FrameEncoder(glob.DELTA_FRAMES, glob.COMPRESS_FRAMES))
+
+    glob.governor = lib.FrameGovernor(fps, glob.MAX_LATENCY, policy)    # The transmit thread of an earlier connection ended in disconnect()
+    lib.init_thread(lib.transmit_loop, server)
+    return server
+
+
+def disconnect(server):
+    server.sendall(b'\x00Q')     # Telling the server to hang up connection
+    lib.close_connection(server)   # Ends the transmit thread of this connection
+
+
+def wait_sent():
+    """
+    Waits until the transmit thread has sent everything presented and the server has acknowledged it
+    """
+    while glob.governor.pending: sleep(0.001)
+    sleep(0.1)      # The transmit thread finishes buffer_to_screen()
+    if glob.frame_link: glob.frame_link.drain()
+
+
+def static_image(end):
+    animation = assets.cache.get(ASSETS[0])
+    while monotonic() < end:
+        glob.led_buffer.copy_from(animation.frames[0])
+        lib.present()
+
+
+def gif_playback(end):
+    animation = assets.cache.get(ASSETS[1])
+    while monotonic() < end:
+        for frame in animation.frames:
+            glob.led_buffer.copy_from(frame)
+            lib.present()
+
+
+def scroll(end, aa):
+    letters, display_buffer = lib.text_to_buffer(TEXT, 100, 10, 5)
+    canvas = ScrollCanvas(display_buffer, 16)
+    steps = glob.SCROLL_STEPS if aa else 1
+    frames = np.zeros((steps, 16, 16, 3), dtype=np.uint8)
+    offset = 0
+    while monotonic() < end:
+        lib.subpixel_frames(canvas.window(offset, 1), steps, frames)
+        for frame in frames:
+            glob.led_buffer.blit(frame)
+            lib.present()
+        offset += 1
+
+
+def clock(end):
+    digital = DigitalClock([255, 128, 0])
+    now = datetime(2026, 12, 31, 22, 0)
+    glob.led_buffer.clear()
+    digital.draw(glob.led_buffer, now, force=True)
+    lib.present()
+    while monotonic() < end:
+        now += timedelta(minutes=1)     # A minute per frame, so the clock has something to redraw
+        if digital.draw(glob.led_buffer, now): lib.present()
+
+
+WORKLOADS = {'static_image': static_image,
+             'gif_playback': gif_playback,
+             'scroll_aa': lambda end: scroll(end, True),
+             'scroll_no_aa': lambda end: scroll(end, False),
+             'clock': clock}
+
+
+def run_workload(workload, seconds):
+    """
+    @return: dict with the results of one workload
+    """
+    glob.led_buffer.clear()
+    lib.present()
+    wait_sent()
+
+    stats.reset()
+    if glob.frame_link: glob.frame_link.encoder.reset_counters()    # One encoder per connection, counting this workload only
+    published, dropped = glob.governor.published, glob.governor.dropped
+    skipped = glob.frame_filter.skipped + glob.frame_filter.skipped_similar
+    cpu = process_time()
+    start = monotonic()
+
+    workload(start + seconds)
+    wait_sent()
+
+    elapsed = monotonic() - start
+    cpu = process_time() - cpu
+    snapshot = stats.snapshot()
+    sent = snapshot['counters']['frames']
+    presented = glob.governor.published - published
+    return {'seconds': elapsed,
+            'presented': presented,
+            'presented_fps': presented / elapsed,
+            'sent': sent,
+            'sent_fps': sent / elapsed,
+            'dropped': glob.governor.dropped - dropped,
+            'skipped': glob.frame_filter.skipped + glob.frame_filter.skipped_similar - skipped,
+            'cpu_us_per_frame': cpu / max(sent, 1) * 1e6,
+            'cpu_us_per_presented': cpu / max(presented, 1) * 1e6,
+            'stages': {stage: {key: values[key] for key in ('count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms')}
+                       for stage, values in snapshot['stages'].items()},
+            'encoder': snapshot.get('encoder')}
+
+
+def main():
+    global ASSETS
+
+    parser = argparse.ArgumentParser(description='SparkLED benchmark suite, results as JSON')
+    parser.add_argument('--host', default='127.0.0.1', help='server to benchmark against (default: start a headless emulator)')
+    parser.add_argument('--port', type=int, default=2290, help='port of the server')
+    parser.add_argument('--external', action='store_true', help="don't start an emulator, use the server at --host/--port")
+    parser.add_argument('--protocols', default='1,2', help='protocol versions to run the workloads with')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='workloads to run')
+    parser.add_argument('--seconds', type=float, default=3, help='duration of each workload')
+    parser.add_argument('--fps', type=float, default=10000, help='frame rate cap (high, so the link is the limit)')
+    parser.add_argument('--policy', default='block', help="frame policy: 'block' (every frame is sent) or 'drop'")
+    parser.add_argument('--no-micro', action='store_true', help='skip the micro-benchmarks')
+    parser.add_argument('--no-workloads', action='store_true', help='skip the end to end workloads')
+    parser.add_argument('--output', help='write the JSON here in stead of to stdout')
+    args = parser.parse_args()
+
+    glob.DEBUG = False      # No per-frame printing
+    directory = tempfile.mkdtemp(prefix='sparkled_benchmark_')
+    ASSETS = make_assets(directory)
+
+    results = {'started': datetime.now().isoformat(timespec='seconds'),
+               'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                               'platform': platform.platform(), 'processor': platform.processor()},
+               'settings': {'seconds': args.seconds, 'fps_cap': args.fps, 'policy': args.policy,
+                            'pipeline_window': glob.PIPELINE_WINDOW, 'delta_frames': glob.DELTA_FRAMES,
+                            'compress_frames': glob.COMPRESS_FRAMES, 'skip_duplicates': glob.SKIP_DUPLICATES}}
+
+    results['codecs'] = check_codecs()      # Speed means nothing if the frames don't survive the trip
+    if not args.no_micro:
+        results['micro'] = micro_benchmarks()
+
+    if not args.no_workloads:
+        emulator = None if args.external else start_emulator(args.port)
+        try:
+            results['workloads'] = {}
+            for version in [int(version) for version in args.protocols.split(',')]:
+                server = connect(args.host, args.port, version, args.fps, args.policy)
+                runs = results['workloads']['protocol_' + str(glob.protocol_version)] = {}
+                for name in args.workloads.split(','):
+                    runs[name] = run_workload(WORKLOADS[name], args.seconds)
+                disconnect(server)
+        finally:
+            if emulator: emulator.terminate()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file: file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
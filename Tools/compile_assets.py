@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# __author__ = 'olesk'
+
+#
+#   Compiles a directory of PNG and GIF images into packed animation files (see SparkLED_assets.py),
+#   which show_img() plays straight from a memory map without decoding anything.
+#   The images are decoded in parallel, one process per CPU core. Images that aren't the size of the panel
+#   are rejected, unless --resize is given. Alpha channels are merged with black, like show_img() does.
+#
+#   Example: python3 compile_assets.py ../images --out ../images
+#
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))    # SparkLED_assets lives one level up
+import SparkLED_assets as assets
+
+EXTENSIONS = ('.png', '.gif')
+
+
+def compile_image(source, target, width, height, resize):
+    """
+    Compiles one image, run in a worker process
+    @return: (source, error message or None, number of frames)
+    """
+    try:
+        animation = assets.decode_image(source, width, height, resize)
+        assets.write_compiled(animation, target)
+    except (OSError, ValueError) as e:
+        return source, str(e), 0
+    return source, None, len(animation)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile PNG/GIF images into packed SparkLED animations')
+    parser.add_argument('source', help='directory with the images')
+    parser.add_argument('--out', help='directory for the compiled files (default: the source directory)')
+    parser.add_argument('--width', type=int, default=16, help='panel width in LEDs')
+    parser.add_argument('--height', type=int, default=16, help='panel height in LEDs')
+    parser.add_argument('--resize', action='store_true', help='scale images of another size in stead of rejecting them')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: one per CPU core)')
+    parser.add_argument('--force', action='store_true', help='recompile images that are older than their compiled file')
+    args = parser.parse_args()
+
+    out = args.out or args.source
+    os.makedirs(out, exist_ok=True)
+
+    work = []
+    for name in sorted(os.listdir(args.source)):
+        if not name.lower().endswith(EXTENSIONS): continue
+        source = os.path.join(args.source, name)
+        target = os.path.join(out, os.path.splitext(name)[0] + assets.COMPILED_EXTENSION)
+        if not args.force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source): continue
+        work.append((source, target))
+
+    if not work:
+        print("Nothing to compile")
+        return 0
+
+    failed = 0
+    with ProcessPoolExecutor(args.jobs) as pool:
+        results = [pool.submit(compile_image, source, target, args.width, args.height, args.resize) for source, target in work]
+        for result in results:
+            source, error, frames = result.result()
+            if error:
+                failed += 1
+                print("ERROR:", error)
+            else:
+                print("Compiled", source, "-", frames, "frame(s)")
+
+    print("Compiled", len(work) - failed, "of", len(work), "images")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,119 +9,575 @@
 #   as server address in the client scripts, not the machine name or IP address, as that
 #   might not work, depending on your network setup.
 #
-import pygame, sys
-from pygame.locals import *
+#   It speaks both the stop-and-wait protocol of the Spark Core firmware and the pipelined
+#   protocol 2 (see SparkLED_protocol.py). Run it with --max-protocol 1 to make it behave like the
+#   real Core, which is useful for comparing the throughput of the two.
+#   Give --port several values to emulate a wall of panels (see SparkLED_canvas.py): every port is a
+#   panel of its own, shown side by side in the window. Every connection is served by a thread of its own,
+#   so several clients can talk to the emulator at once (clients on the same port share its panel).
+#   With --headless it needs no display (and no pygame), for benchmarks (Tools/benchmark.py) and load tests.
+#   With --record every frame shown is written to a file with a timestamp, see FrameRecorder for the format.
+#
+#   Over loopback the emulator answers at once, which makes frame rates look much better than what the Core
+#   manages over Wi-Fi. --link picks a model of the real link (see LINKS): latency with jitter, a bandwidth cap,
+#   the time the Core spends writing the LEDs, and now and then a stall or a dropped connection. The settings
+#   of a model can be overridden one by one, e.g. --link wifi --latency 40. --seed makes the randomness repeatable.
+#
+import sys
+import argparse
+import os
+import random
+import select
+import signal
 import socket
-from pygame.locals import *
+import struct
+import threading
 import time
+from collections import deque
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))    # SparkLED_protocol lives one level up
+import SparkLED_protocol as protocol
+from SparkLED_framebuffer import FrameSerializer
 
 WHITE = (255, 255, 255)
 GREEN = (0, 255, 0)
 BLUE = (0, 0, 128)
 
 TCP_IP = '127.0.0.1'
-TCP_PORT = 2208
 BUFFER_SIZE = 1024  # Normally 1024, but we want fast response
+FRAME_SIZE = 768    # 16 x 16 LEDs, 3 bytes each
+ROW_ORDER = np.argsort(FrameSerializer(16, 16).permutation)    # ROW_ORDER[n]: the LED showing pixel n (row order) of the panel
+MAX_CLIENTS = 8     # Connections waiting to be accepted, per port
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)   # Important to not block sockets in Windows
-s.bind((TCP_IP, TCP_PORT))
-s.listen(1)
+RECORDING_MAGIC = b'SLEDREC1'
+RECORDING_FRAME = struct.Struct('<dHH')     # Seconds since the recording started, port, frame size - then the frame
 
-displayUpdates = 0
-start = time.clock()    # resetting timer
-#print ('Connection from:', addr)
+# Link models, rough numbers for a Spark Core on a home network. Latency, jitter, LED write and stall are in
+# milliseconds, bandwidth in kbit/s (0: no cap), stall and disconnect rates are chances per frame shown.
+# Writing 256 WS2812 LEDs takes 256 * 24 bits * 1.25 us = 7.7 ms, during which the Core reads nothing
+LINKS = {
+    'loopback': {},
+    'core':     {'latency': 3, 'jitter': 2, 'bandwidth': 1000, 'led_delay': 8},
+    'wifi':     {'latency': 10, 'jitter': 15, 'bandwidth': 1000, 'led_delay': 8, 'stall_rate': 0.002, 'stall': 300},
+    'bad-wifi': {'latency': 30, 'jitter': 50, 'bandwidth': 500, 'led_delay': 8, 'stall_rate': 0.01, 'stall': 1000,
+                 'disconnect_rate': 0.001},
+}
 
+HEADLESS = False
+MAX_PROTOCOL = protocol.PROTOCOL_MAX
+SCALE = 50          # Screen pixels per LED
+MAX_DRAW_FPS = 120  # The window is redrawn at most this often, frames in between are counted but not drawn
 
-pygame.init()
 
-DISPLAYSURF = pygame.display.set_mode((16*50, 16*50))
-pygame.display.set_caption('LED Server Emulator')
-#fontObj = pygame.font.Font('freesansbold.ttf', 32)
+class StreamReader:
+    """
+    Buffered reads from the client connection. TCP is a byte stream, so one recv() can hold half a
+    message or several messages (which is what we get with pipelined frames) - we always read exact sizes.
+    """
 
-print("Listening for connections - no timeout")
-conn, addr = s.accept()
-s.settimeout(2)
-while True: # main game loop
+    def __init__(self, conn, on_dry=None):
+        """
+        @param conn: the client connection
+        @param on_dry: optional function called before read() waits for data that hasn't arrived yet
+        """
+        self.conn = conn
+        self.buffer = bytearray()
+        self.on_dry = on_dry
 
-    while True:
-        try:
-            data = conn.recv(BUFFER_SIZE)
-            break
-        except socket.error as e:
-            err = e.args[0]
-            # this next if/else is a bit redundant, but illustrates how the
-            # timeout exception is setup
-            print("Error: ", err)
-            print("Listening for connections - no timeout")
-            s.settimeout(60*60)     # 1 hour timeout
-            conn, addr = s.accept()
-            s.settimeout(2)
-            displayUpdates = 0      # resetting counter
-
-    #if not data: break
-    if data == b'\x00K':
-        print("Received proper connection request (b'\\x00K')", end='')
-        conn.send(b'A')
-        print(" <= ACK sent\n\n")
-
-    elif data == b'\x00G':
-        #print("Received proper go! code (b'\\x00G')", end='')
-        conn.send(b'A')
-        #print(" <= ACK sent back to client - ready to receive screen update")
+    def read(self, size):
+        while len(self.buffer) < size:
+            if self.on_dry and not self.arrived(): self.on_dry()     # We are about to wait for the client
+            data = self.conn.recv(max(BUFFER_SIZE, size - len(self.buffer)))
+            if not data: raise ConnectionResetError("Client closed the connection")
+            self.buffer += data
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def arrived(self):
+        """
+        @return: True if more data from the client has arrived and is waiting to be received
+        """
+        if isinstance(self.conn, ImpairedConnection): return self.conn.pending()
+        return bool(select.select([self.conn], [], [], 0)[0])
+
+
+class LinkModel:
+    """
+    How the emulated link between client and Core behaves (see LINKS). Thread safe
+    """
+
+    def __init__(self, latency=0, jitter=0, bandwidth=0, led_delay=0, stall_rate=0, stall=0, disconnect_rate=0, seed=None):
+        """
+        @param latency: one way delay of every message, ms
+        @param jitter: the delay varies this much (ms) up or down, evenly distributed
+        @param bandwidth: kbit/s from the client to the Core, 0 for no limit
+        @param led_delay: ms to write a frame to the LEDs, the Core doesn't read anything meanwhile
+        @param stall_rate: chance per frame that the Core stops for a while (Wi-Fi trouble, cloud housekeeping)
+        @param stall: ms the Core stops
+        @param disconnect_rate: chance per frame that the Core drops the connection
+        @param seed: seed for the random numbers, for repeatable runs
+        """
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.bandwidth = bandwidth * 1000 / 8       # Bytes per second
+        self.led_delay = led_delay / 1000
+        self.stall_rate = stall_rate
+        self.stall = stall / 1000
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stalls = 0
+        self.disconnects = 0
+
+    @property
+    def impaired(self):
+        """
+        True if messages need to be delayed, i.e. connections need an ImpairedConnection
+        """
+        return bool(self.latency or self.jitter or self.bandwidth)
+
+    def delay(self):
+        """
+        @return: seconds a message spends on the way, latency with jitter
+        """
+        if not self.jitter: return self.latency
+        with self.lock:
+            return max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+
+    def transfer_time(self, size):
+        """
+        @return: seconds it takes to push size bytes through the link
+        """
+        return size / self.bandwidth if self.bandwidth else 0
+
+    def frame(self):
+        """
+        Called by the connection thread when a frame is put on the LEDs: writes the LEDs and maybe stalls
+        @return: False if the Core drops the connection
+        """
+        if self.led_delay: time.sleep(self.led_delay)
+        if not self.stall_rate and not self.disconnect_rate: return True
+
+        with self.lock:
+            stall = self.random.random() < self.stall_rate
+            disconnect = self.random.random() < self.disconnect_rate
+            self.stalls += stall
+            self.disconnects += disconnect
+        if stall:
+            print("Simulating a stall of", int(self.stall * 1000), "ms")
+            time.sleep(self.stall)
+        return not disconnect
+
+    def __str__(self):
+        return "latency {:g} +/- {:g} ms, bandwidth {}, LED write {:g} ms, stalls {:g}% of {:g} ms, disconnects {:g}%".format(
+            self.latency * 1000, self.jitter * 1000,
+            "{:g} kbit/s".format(self.bandwidth * 8 / 1000) if self.bandwidth else "unlimited",
+            self.led_delay * 1000, self.stall_rate * 100, self.stall * 1000, self.disconnect_rate * 100)
+
+
+LINK = LinkModel()  # Loopback: no impairments, main() sets up the one asked for
+
+
+class ImpairedConnection:
+    """
+    Socket wrapper which hands us the client's data, and the client our answers, when the link model says they arrive.
+    A thread receives from the client as fast as it can and stamps every chunk with its arrival time over the
+    modelled link, so messages in flight overlap like they do on a real network: latency delays pipelined frames,
+    but doesn't throttle them. Another thread sends our answers when they are due. Bytes stay in order, like with TCP
+    """
+
+    def __init__(self, conn, link):
+        self.conn = conn
+        self.link = link
+        self.incoming = deque()         # (arrival time, data) - b'' when the client has closed the connection
+        self.outgoing = deque()         # (arrival time, data) - None to close the connection
+        self.received = threading.Condition()
+        self.sending = threading.Condition()
+        self.link_free = 0.0            # When the link has pushed through everything received so far
+        self.last_in = 0.0              # Arrival time of the last chunk in each direction, nothing overtakes it
+        self.last_out = 0.0
+
+        for target in (self._receive, self._send):
+            thread = threading.Thread(target=target)
+            thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+            thread.start()
+
+    def _receive(self):
+        while True:
+            try:
+                data = self.conn.recv(BUFFER_SIZE * 4)
+            except OSError:
+                data = b''
+            self.link_free = max(time.perf_counter(), self.link_free) + self.link.transfer_time(len(data))
+            self.last_in = max(self.link_free + self.link.delay(), self.last_in)
+            with self.received:
+                self.incoming.append((self.last_in, data))
+                self.received.notify()
+            if not data: return
+
+    def _send(self):
+        while True:
+            with self.sending:
+                while not self.outgoing: self.sending.wait()
+                due, data = self.outgoing.popleft()
+            if data is None: break
+
+            wait = due - time.perf_counter()
+            if wait > 0: time.sleep(wait)
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                break
 
         try:
-            data = conn.recv(BUFFER_SIZE)
-        except socket.error as e:
-            err = e.args[0]
-            # this next if/else is a bit redundant, but illustrates how the
-            # timeout exception is setup
-            print("Error: ", err)
-            print("Listening for connections - no timeout")
-            s.settimeout(60*60)     # 1 hour timeout
-            conn, addr = s.accept()
-            s.settimeout(2)
-            displayUpdates = 0      # resetting counter
-
-        if len(data) == 768:
-            #print("Got full screen update (768) bytes)", end='')
-
-            x = 0
-            y = 0
-            for n in range(0, 768, 3):
-                for event in pygame.event.get(): pass
-
-                pygame.draw.rect(DISPLAYSURF, (data[n], data[n + 1] ,data[n + 2]), (x * 50, y * 50, 50, 50))   # (x,y, width, height)
-                x += 1
-                if x == 16:
-                    x = 0
-                    y += 1
-
-            pygame.display.update()
-            for event in pygame.event.get():
-                if event.type == QUIT:
-                    pygame.quit()
-                    s.close()
-                    sys.exit()
+            self.conn.shutdown(socket.SHUT_RDWR)    # Wakes up _receive()
+        except OSError:
+            pass
+        self.conn.close()
+
+    def recv(self, size):
+        with self.received:
+            while not self.incoming: self.received.wait()
+            due, data = self.incoming[0]
+
+        wait = due - time.perf_counter()
+        if wait > 0: time.sleep(wait)
+
+        with self.received:
+            if len(data) > size:
+                self.incoming[0] = (due, data[size:])
+                return data[:size]
+            self.incoming.popleft()
+            return data
+
+    def pending(self):
+        """
+        @return: True if data from the client has arrived (over the modelled link) and is waiting to be read
+        """
+        with self.received:
+            return bool(self.incoming) and self.incoming[0][0] <= time.perf_counter()
+
+    def send(self, data):
+        self.last_out = max(time.perf_counter() + self.link.delay(), self.last_out)
+        with self.sending:
+            self.outgoing.append((self.last_out, data))
+            self.sending.notify()
+        return len(data)
+
+    def close(self):
+        """
+        Closes the connection once the answers on their way have been sent
+        """
+        with self.sending:
+            self.outgoing.append((0, None))
+            self.sending.notify()
+
+
+class FrameRecorder:
+    """
+    Writes every frame shown to a file: RECORDING_MAGIC, then per frame a RECORDING_FRAME header and the
+    frame in wire order (768 bytes for a 16x16 panel). Read it back with read_recording(). Thread safe
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(RECORDING_MAGIC)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.frames = 0
+
+    def write(self, port, frame):
+        with self.lock:
+            if self.file.closed: return
+            self.file.write(RECORDING_FRAME.pack(time.perf_counter() - self.start, port, len(frame)))
+            self.file.write(frame)
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(path):
+    """
+    Reads a file written by FrameRecorder
+    @param path: File name (relative or abs path)
+    @return: generator of (seconds since the recording started, port, frame as uint8 array in wire order)
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError("{} is not an emulator recording".format(path))
+        while True:
+            header = file.read(RECORDING_FRAME.size)
+            if len(header) < RECORDING_FRAME.size: return       # End of file (or a recording cut short)
+            seconds, port, size = RECORDING_FRAME.unpack(header)
+            frame = file.read(size)
+            if len(frame) < size: return
+            yield seconds, port, np.frombuffer(frame, dtype=np.uint8)
+
+
+class Panel:
+    """
+    One emulated Spark Core + LED display, listening on its own port. Connection threads update the pixels,
+    the main thread draws them
+    """
+
+    def __init__(self, port, position, recorder=None):
+        """
+        @param port: TCP port to listen on
+        @param position: where the panel is in the window, 0 is leftmost
+        @param recorder: FrameRecorder or None
+        """
+        self.port = port
+        self.position = position
+        self.recorder = recorder
+        self.pixels = np.zeros(FRAME_SIZE, dtype=np.uint8)     # What the LEDs show
+        self.lock = threading.Lock()
+        self.dirty = False          # The pixels have changed since they were last drawn
+        self.updates = 0
+        self.start = time.perf_counter()
+        self.rect = None            # The panel's part of the window
+        self.surface = None         # Subsurface of DISPLAYSURF for the rect, which draw() scales the frame into
+        self.leds = None            # 16x16 surface, one pixel per LED, in the same pixel format as the window
+
+    def show(self, frame):
+        """
+        Puts a frame on the LEDs
+        @param frame: uint8 array of FRAME_SIZE bytes in wire order
+        """
+        with self.lock:
+            self.pixels[:] = frame
+            self.dirty = True
+        if self.recorder: self.recorder.write(self.port, frame)
+        self.frame_done()
+
+    def take(self):
+        """
+        @return: copy of the pixels if they have changed since the last call, otherwise None
+        """
+        with self.lock:
+            if not self.dirty: return None
+            self.dirty = False
+            return self.pixels.copy()
 
+    def frame_done(self):
+        now = time.perf_counter()
+        fps = int(1 / max(now - self.start, 1e-6))
+        print("Port", self.port, "display updates: ", self.updates, " fps: ", fps)
+        self.start = now    # resetting timer (time.clock() is gone from Python 3.8 and later)
+        self.updates += 1
+
+
+def draw(panel, data):
+    """
+    Draws a frame on the panel's part of the window, as the panel shows it: the frame is in wire order, with every
+    second row wired in the opposite direction (FrameSerializer's default serpentine wiring), so one gather through
+    ROW_ORDER puts the LEDs back in rows. The 16x16 image is copied into a 16x16 surface in one go (surfarray wants
+    x before y) and scaled up straight into the window in one blit
+    @param data: uint8 array of FRAME_SIZE bytes
+    """
+    pixels = data.reshape(-1, 3)[ROW_ORDER]
+    pygame.surfarray.blit_array(panel.leds, pixels.reshape(16, 16, 3).swapaxes(0, 1))
+    pygame.transform.scale(panel.leds, panel.rect.size, panel.surface)
+
+
+def serve(conn, panel):
+    """
+    Handles one client connection until it disconnects
+    """
+    frame = np.zeros(FRAME_SIZE, dtype=np.uint8)   # What we are showing, which delta frames are applied to
+    unacked = [None]    # Sequence of the last frame not acked yet
+
+    def ack():
+        # Acks are cumulative: frames that are already waiting are acked in one go, once we run out of them
+        if unacked[0] is None: return
+        conn.send(protocol.ACK.pack(protocol.ACK_CODE, unacked[0]))
+        unacked[0] = None
+
+    reader = StreamReader(conn, on_dry=ack)
+
+    def show():
+        panel.show(frame)
+        if not LINK.frame(): raise ConnectionResetError("Simulated disconnect")
+
+    while True:
+        data = reader.read(2)
+        if data != b'\x00' + protocol.FRAME_CODE: ack()     # Anything but a frame is answered after the frames before it
+
+        if data[0] != 0:
+            print("Got malformed data, dropping the connection: ", data)
+            return
+
+        if data == b'\x00K':
+            print("Received proper connection request (b'\\x00K')", end='')
+            conn.send(b'A')
+            print(" <= ACK sent\n\n")
+
+        elif data[1] < 0x20:    # \x00<version>: the client asks for a protocol version, sent right after \x00K
+            if MAX_PROTOCOL >= protocol.PROTOCOL_PIPELINED:
+                version = min(data[1], MAX_PROTOCOL)
+                conn.send(protocol.VERSION_CODE + bytes([version]))
+                print("Agreed on protocol version", version)
+            else:
+                print("Client asked for protocol version", data[1], "- ignoring, like the Spark Core does")
+
+        elif data == b'\x00G':
+            #print("Received proper go! code (b'\\x00G')", end='')
+            conn.send(b'A')
+            #print(" <= ACK sent back to client - ready to receive screen update")
+
+            frame[:] = np.frombuffer(reader.read(FRAME_SIZE), dtype=np.uint8)
+            show()
             conn.send(b'D')     # We are Done!
             #print(" <= ACK ('D') ready for next")
-            fps = int(1 / (time.clock() - start))
-            print("Display updates: ", displayUpdates, " fps: ", fps)
-            start = time.clock()    # resetting timer
-            displayUpdates += 1
+
+        elif data == b'\x00' + protocol.FRAME_CODE:
+            kind, sequence, length = protocol.FRAME_HEADER.unpack(data + reader.read(protocol.FRAME_HEADER.size - 2))[1:]
+            payload = reader.read(length)
+
+            held = kind & protocol.KIND_HOLD
+            if not protocol.decode_frame(kind & ~protocol.KIND_HOLD, payload, frame):   # Keyframes replace the frame, deltas update it
+                print("ERROR: Unable to decode frame kind", kind, "with", length, "bytes")
+            elif not held:
+                show()
+
+            unacked[0] = sequence       # Acked by ack(), when the frames waiting run out or something else comes
+
+        elif data == b'\x00' + protocol.SHOW_CODE:      # Showing the frame loaded with the KIND_HOLD flag
+            show()
+
+        elif data == b'\x00B':
+            reader.read(1)      # The brightness value
+            print("Got brightness request - ignoring")
+            conn.send(b'D')     # We are Done!
+
+        elif data == b'\x00T':
+            print("Got hardware test request - ignoring")
+            conn.send(b'D')     # We are Done!
+
+        elif data == b'\x00Z':
+            print("Got blank request")
+            panel.show(np.zeros(FRAME_SIZE, dtype=np.uint8))     # Blanks the LEDs, deltas still apply to the last frame
+
+        elif data == b'\x00Q':
+            print("Client hung up")
+            return
 
         else:
-            print("ERROR: Expected 768 bytes of data, got ", len(data))
-            print("Data received: ", data)
+            print("Got malformed data, dropping the connection: ", data)
+            return
+
+
+def handle(conn, addr, panel):
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # Acks are tiny, we want them out at once
+    print("Port", panel.port, "connection from", addr)
+    panel.updates = 0       # resetting counter
+    if LINK.impaired: conn = ImpairedConnection(conn, LINK)
+
+    try:
+        serve(conn, panel)
+    except socket.error as e:
+        print("Error: ", e)
+
+    conn.close()
+
+
+def listen(panel):
+    """
+    Accepts connections for a panel, serving every client from a thread of its own
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)   # Important to not block sockets in Windows
+    s.bind((TCP_IP, panel.port))
+    s.listen(MAX_CLIENTS)
+    print("Listening for connections on port", panel.port, "- no timeout")
+
+    while True:
+        conn, addr = s.accept()
+        thread = threading.Thread(target=handle, args=(conn, addr, panel))
+        thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+        thread.start()
 
-    elif data == b'\x00B':
-        print("Got brightness request - ignoring")
-        conn.send(b'D')     # We are Done!
 
-    else:
-        print("Got malformed data, exiting: ", data)
+def main():
+    global HEADLESS, MAX_PROTOCOL, SCALE, LINK, DISPLAYSURF, pygame
+
+    parser = argparse.ArgumentParser(description='Spark Core + LED display emulator')
+    parser.add_argument('--port', type=int, nargs='+', default=[2208], help='TCP port(s) to listen on, one panel per port')
+    parser.add_argument('--max-protocol', type=int, default=protocol.PROTOCOL_MAX,
+                        help='1: stop-and-wait only (like the Spark Core firmware), 2: also pipelined frames')
+    parser.add_argument('--headless', action='store_true', help='no window: frames are decoded and counted, but not drawn')
+    parser.add_argument('--record', metavar='FILE', help='write every frame shown, with a timestamp, to FILE')
+    parser.add_argument('--scale', type=int, default=SCALE, help='screen pixels per LED')
+    link = parser.add_argument_group('link model', 'impairments of the link to the Core, overriding the --link model')
+    link.add_argument('--link', choices=sorted(LINKS), default='loopback', help='link model to start from')
+    link.add_argument('--latency', type=float, help='one way delay of every message, ms')
+    link.add_argument('--jitter', type=float, help='the delay varies this much up or down, ms')
+    link.add_argument('--bandwidth', type=float, help='kbit/s from client to Core, 0 for no limit')
+    link.add_argument('--led-delay', type=float, help='ms the Core spends writing a frame to the LEDs')
+    link.add_argument('--stall-rate', type=float, help='chance per frame that the Core stops for --stall ms')
+    link.add_argument('--stall', type=float, help='ms the Core stops')
+    link.add_argument('--disconnect-rate', type=float, help='chance per frame that the Core drops the connection')
+    link.add_argument('--seed', type=int, help='seed for the random numbers, for repeatable runs')
+    args = parser.parse_args()
+
+    HEADLESS = args.headless
+    MAX_PROTOCOL = args.max_protocol
+    SCALE = args.scale
+
+    settings = dict(LINKS[args.link])
+    for name in ('latency', 'jitter', 'bandwidth', 'led_delay', 'stall_rate', 'stall', 'disconnect_rate'):
+        if getattr(args, name) is not None: settings[name] = getattr(args, name)
+    LINK = LinkModel(seed=args.seed, **settings)
+    print("Link model:", LINK)
+
+    signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit())     # Closing the recording when we're terminated
+    recorder = FrameRecorder(args.record) if args.record else None
+    panels = [Panel(port, position, recorder) for position, port in enumerate(args.port)]
+    for panel in panels:
+        thread = threading.Thread(target=listen, args=(panel,))
+        thread.daemon = True  # thread dies when main thread (only non-daemon thread) exits.
+        thread.start()
+
+    try:
+        if HEADLESS:
+            while True: time.sleep(1)
+
+        import pygame
+        from pygame.locals import QUIT
+        pygame.init()
+
+        DISPLAYSURF = pygame.display.set_mode((16 * SCALE * len(panels), 16 * SCALE))
+        pygame.display.set_caption('LED Server Emulator - port ' + ', '.join(str(port) for port in args.port))
+        #fontObj = pygame.font.Font('freesansbold.ttf', 32)
+        for panel in panels:
+            panel.rect = pygame.Rect(panel.position * 16 * SCALE, 0, 16 * SCALE, 16 * SCALE)
+            panel.surface = DISPLAYSURF.subsurface(panel.rect)
+            panel.leds = pygame.Surface((16, 16), 0, DISPLAYSURF)
+
+        clock = pygame.time.Clock()
+        while True: # main game loop: the connection threads update the panels, we draw the latest frames
+            dirty = []
+            for panel in panels:
+                data = panel.take()
+                if data is not None:
+                    draw(panel, data)
+                    dirty.append(panel.rect)
+            if dirty: pygame.display.update(dirty)
+
+            if any(event.type == QUIT for event in pygame.event.get()): break   # Events once per frame
+            clock.tick(MAX_DRAW_FPS)
         pygame.quit()
-        s.close()
-        sys.exit()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if recorder:
+            recorder.close()
+            print("Recorded", recorder.frames, "frames to", args.record)
+
 
+if __name__ == "__main__":
+    main()
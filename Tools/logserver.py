@@ -9,50 +9,295 @@
 
 		Message format for sensors and other who want to log data:
 		sensorname:level:value  (level is LOGLEVEL, normally info)
+		                        -> ack ==> sensorname:level:value
 
 		Message format for clients who want to read data:
 		req:sensorname  <- get last reading from sensor
+		                -> sensorname:level:value, or nak ==> sensorname if we haven't heard from it
 
 		Message format for clients who want to check for priority messages:
 		pri             <- pop last priority message from priority stack
+		                -> sensorname:level:value, or none
+
+		Message format for clients who want priority messages the moment they arrive, in stead of asking with pri:
+		sub             <- subscribe to CRIT messages on this connection
+		                -> ack ==> sub, then evt ==> sensorname:CRIT:value for every CRIT message logged from now on
+
+		Every client is served at once from one thread (selectors), and connections are persistent: a client
+		can send as many messages as it likes, each ending with a newline, and gets one answer line per
+		message. Clients that send a single message without a newline (like the first sensors did) are still
+		understood, and get their answer without a newline, after which we close the connection as they expect.
+		A first message is taken as such when no newline follows within LEGACY_WAIT seconds, or when the client
+		shuts down its side of the connection, so a line that arrives in pieces is still a line.
+		The latest reading of every sensor is kept in a dict, so req is answered without touching the log.
+		CRIT and ERROR messages go on the priority stack: pri pops the most severe, newest first. The stack
+		holds at most MAX_PRIORITY messages, when it is full the least severe, oldest message is dropped.
 """
+import argparse
+import bisect
+import itertools
 import logging
+import selectors
 import socket
 import sys
 import signal
+from time import monotonic
 
 HOST = ''       # Symbolic name meaning all available interfaces
 PORT = 2208     # Arbitrary non-privileged port
-MAX_CONN = 10   # Maximum simultaneous connections
+MAX_CONN = 10   # Maximum connections waiting to be accepted
+MAX_LINE = 1024     # Longest message we accept, a client sending longer lines is disconnected
+MAX_OUTGOING = 65536    # Most bytes of answers waiting for a client, a client that doesn't read them is disconnected
+MAX_PRIORITY = 100  # Most messages kept on the priority stack
+PRIORITY_LEVELS = {'ERROR': 1, 'CRIT': 2}  # Levels that go on the priority stack, the higher the more severe
+EVENT_LEVEL = 'CRIT'    # Messages of this level are pushed to the subscribers
+LEGACY_WAIT = 0.2       # Seconds the start of a first message waits for its newline, before it's taken as an old client's message
+
+
+class PriorityStack:
+	"""
+	Bounded stack of priority messages, kept sorted by (severity, arrival)
+	"""
+
+	def __init__(self, size=MAX_PRIORITY):
+		self.size = size
+		self.messages = []              # (severity, arrival, message), least severe and oldest first
+		self.arrivals = itertools.count()
+		self.dropped = 0
+
+	def push(self, severity, message):
+		bisect.insort(self.messages, (severity, next(self.arrivals), message))
+		if len(self.messages) > self.size:
+			del self.messages[0]        # Least severe, oldest
+			self.dropped += 1
+
+	def pop(self):
+		"""
+		@return: the most severe message, newest first, or None if the stack is empty
+		"""
+		return self.messages.pop()[2] if self.messages else None
+
+	def __len__(self):
+		return len(self.messages)
+
+
+latest = {}                 # sensorname -> 'sensorname:level:value', the last reading from each sensor
+priority = PriorityStack()
+subscribers = set()         # Clients that have sent sub
+undecided = set()           # Clients that have sent part of a first message, without a newline so far
+
+
+class Client:
+	"""
+	State of one connection: what it has sent that we haven't handled yet
+	"""
+
+	def __init__(self, conn, addr):
+		self.conn = conn
+		self.addr = addr
+		self.buffer = b''
+		self.outgoing = b''     # Answers the socket hasn't taken yet
+		self.writing = False    # True while the selector watches for the socket taking more
+		self.lines = False      # True once the client has sent a newline: it speaks in lines, and gets lines back
+		self.close_after_send = False   # True for old clients: they expect us to hang up once they have their answer
+		self.deadline = None    # When a first message without newline is taken as the one message of an old client
+
+
+def handle_message(selector, client, message):
+	"""
+	@param client: the Client that sent the message
+	@param message: one message from the client, without the newline
+	@return: the answer
+	"""
+	data = message.split(':')      # Converting string to list of strings, split by colon
+
+	if data[0] == 'req' and len(data) == 2:     # Information request
+		sensor = data[1]
+		return latest.get(sensor, 'nak ==> ' + sensor)
+
+	if data == ['pri']:                         # Priority message request
+		return priority.pop() or 'none'
+
+	if data == ['sub']:                         # Subscription to priority messages
+		client.lines = True                     # Events are lines, so the client must read lines
+		subscribers.add(client)
+		return 'ack ==> sub'
+
+	if len(data) != 3: return 'nak ==> ' + message     # Not a message we understand
+
+	[sensor, level, value] = data                       # Data logging
+	reading = sensor + ':' + level + ':' + value
+	logger.info(client.addr[0] + ':' + reading)         # We log the info
+	latest[sensor] = reading
+	if level in PRIORITY_LEVELS: priority.push(PRIORITY_LEVELS[level], reading)
+	if level == EVENT_LEVEL: publish(selector, reading)
+	return 'ack ==> ' + reading                         # We confirm message, allowing the client to resend if it doesn't agree
+
+
+def publish(selector, reading):
+	"""
+	Pushes a reading to every subscriber, before the sensor that sent it gets its ack
+	"""
+	event = ('evt ==> ' + reading + '\n').encode(encoding='utf8')
+	for subscriber in list(subscribers): send(selector, subscriber, event)      # send() may disconnect, and unsubscribe
+
+
+def disconnect(selector, client):
+	if client.conn.fileno() < 0: return         # Already disconnected
+	subscribers.discard(client)
+	undecided.discard(client)
+	selector.unregister(client.conn)
+	client.conn.close()
+
+
+def send(selector, client, data=b''):
+	"""
+	Sends what the socket takes at once, and asks the selector to tell us when it takes the rest
+	@param data: bytes to add to what is waiting for the client
+	"""
+	client.outgoing += data
+	try:
+		sent = client.conn.send(client.outgoing)
+	except (BlockingIOError, InterruptedError):
+		sent = 0
+	except OSError:
+		disconnect(selector, client)
+		return
+	client.outgoing = client.outgoing[sent:]
+	if client.close_after_send and not client.outgoing:
+		disconnect(selector, client)
+		return
+
+	if len(client.outgoing) > MAX_OUTGOING:
+		print('Client', client.addr[0], 'is not reading its answers - disconnecting')
+		disconnect(selector, client)
+		return
+	if client.writing != bool(client.outgoing):
+		client.writing = bool(client.outgoing)
+		if client.close_after_send: events = selectors.EVENT_WRITE    # An old client has nothing more to say, maybe not even an open side
+		elif client.writing: events = selectors.EVENT_READ | selectors.EVENT_WRITE
+		else: events = selectors.EVENT_READ
+		selector.modify(client.conn, events, client)
+
+
+def accept(selector, server):
+	try:
+		conn, addr = server.accept()
+	except (BlockingIOError, InterruptedError):
+		return
+	#logger.debug('Connected with ' + addr[0] + ':' + str(addr[1]))
+	conn.setblocking(False)
+	selector.register(conn, selectors.EVENT_READ, Client(conn, addr))
+
+
+def receive(selector, client):
+	"""
+	Handles what a client has sent: every complete line. The start of a first message stays in the buffer until its
+	newline comes, or until we take it as the one message of an old client (see answer_legacy())
+	"""
+	try:
+		data = client.conn.recv(4096)
+	except (BlockingIOError, InterruptedError):
+		return
+	except OSError:
+		data = b''
+	if not data:
+		if client.buffer.strip() and not client.lines: answer_legacy(selector, client)     # Old client, done sending
+		else: disconnect(selector, client)
+		return
+
+	client.buffer += data
+	if b'\n' in client.buffer:
+		client.lines = True
+		undecided.discard(client)
+	elif not client.lines and client.deadline is None:
+		client.deadline = monotonic() + LEGACY_WAIT
+		undecided.add(client)
+
+	messages = []       # Without a newline so far, we wait for it, or for the deadline
+	if client.lines: *messages, client.buffer = client.buffer.split(b'\n')
+
+	if len(client.buffer) > MAX_LINE:
+		print('Message too long from', client.addr[0], '- disconnecting')
+		disconnect(selector, client)
+		return
+
+	replies = [handle_message(selector, client, message.decode(errors='replace').strip()) for message in messages if message.strip()]
+	if replies: send(selector, client, ''.join(reply + '\n' for reply in replies).encode(encoding='utf8'))     # sockets don't understand unicode strings (Python3 default strings) without encoding
+
+
+def answer_legacy(selector, client):
+	"""
+	Answers a client that sent one message without a newline, like the first sensors did: the answer goes without a
+	newline too, and we hang up once it is sent, as they read until the connection closes
+	"""
+	undecided.discard(client)
+	message, client.buffer = client.buffer.decode(errors='replace').strip(), b''
+	reply = handle_message(selector, client, message) if message else ''
+	client.close_after_send = not client.lines      # Unless it was a sub, after which we keep pushing events
+	if reply: send(selector, client, reply.encode(encoding='utf8'))
+	elif client.close_after_send: disconnect(selector, client)
+
+
+def expire_undecided(selector):
+	"""
+	Takes the first messages that haven't got their newline in time as messages from old clients
+	@return: seconds until the next deadline, None if no client is waiting for one
+	"""
+	now = monotonic()
+	for client in [client for client in undecided if client.deadline <= now]: answer_legacy(selector, client)
+	return max(min(client.deadline for client in undecided) - now, 0) if undecided else None
+
+
+def serve(server):
+	"""
+	Serves every client from one thread until interrupted
+	"""
+	selector = selectors.DefaultSelector()
+	server.setblocking(False)
+	selector.register(server, selectors.EVENT_READ, None)
+
+	timeout = None
+	while True:
+		for key, events in selector.select(timeout):
+			if key.data is None:
+				accept(selector, server)
+				continue
+			if events & selectors.EVENT_WRITE: send(selector, key.data)
+			if events & selectors.EVENT_READ and key.data.conn.fileno() >= 0: receive(selector, key.data)
+		timeout = expire_undecided(selector)
 
-priority = []
 
 # noinspection PyUnusedLocal,PyUnusedLocal,PyShadowingNames
 def signal_handler(signal, frame):
 	print('\n- Interrupted manually, aborting')
 	logger.critical('Abort received, shutting down')
-	server.shutdown()
 	server.close()
 	exit(1)
 
 
+logger = logging.getLogger('msg_logger')
+
+
 if __name__ == "__main__":  # Making sure we don't have problems if importing from this file as a module
 
+	parser = argparse.ArgumentParser(description='SparkLED sensor log server')
+	parser.add_argument('--port', type=int, default=PORT, help='TCP port to listen on')
+	args = parser.parse_args()
+
 	logging.basicConfig(level=logging.DEBUG,      # The lowest log level that will be printed to STDOUT (DEBUG < INFO <WARN < ERROR < CRITICAL)
 	                    format='%(asctime)s:%(message)s',
 	                    datefmt='%d%m%y:%H%M%S',
 	                    filename='sensors.log')
 
-	#logger = logging.getLogger(__name__)
-	logger = logging.getLogger('msg_logger')
-
 	signal.signal(signal.SIGINT, signal_handler)  # Setting up th signal handler to arrange tidy exit if manually interrupted
 
 	server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 	print('Socket created')
 
 	try:
-		server.bind((HOST, PORT))
+		server.bind((HOST, args.port))
 	except socket.error:
 		print('Bind failed')
 		sys.exit()
@@ -60,23 +305,6 @@ if __name__ == "__main__":  # Making sure we don't have problems if importing fr
 	print('Socket bind complete')
 
 	server.listen(MAX_CONN)
-	print('Socket now listening on port ' + str(PORT))
+	print('Socket now listening on port ' + str(args.port))
 
-	while True:
-		#wait to accept a connection - blocking call
-		conn, addr = server.accept()
-		#logger.debug('Connected with ' + addr[0] + ':' + str(addr[1]))
-		data, client_address = conn.recvfrom(1024)
-		data = data.decode()        # Converting from bytearray to string
-		data = data.split(':')      # Converting string to list of strings, split by colon
-		if data[0] == 'req':        # Information request
-			sensor = data[1]
-
-		else:                       # Data logging
-			[sensor, level, value] = data
-			logger.info(addr[0] + ':' + sensor + ':' + level + ':' + value)     # We log the info
-			reply = 'ack ==> ' + sensor + ':' + level + ':' + value             # We confirm message, allowing the client to resend if it doesn't agree
-			if level == 'CRIT': priority.append(sensor + ':' + level + ':' + value)
-			conn.send(bytes(reply.encode(encoding='utf8')))        # sendall doesn't understand unicode strings (Python3 default strings) without encoding
-
-		conn.close()
+	serve(server)